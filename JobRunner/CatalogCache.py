@@ -1,13 +1,85 @@
+import os
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+from time import time as _time
 from clients.CatalogClient import Catalog
+from .resources import parse_hints
+from .catalogstore import CatalogStore
+
+
+class LookupCache(object):
+    """
+    This class holds catalog answers in memory for up to ttl seconds.
+    Failed lookups are remembered for neg_ttl seconds so a broken
+    module doesn't hit the catalog on every submit.  The least recently
+    used entries are dropped past size.
+    """
+
+    def __init__(self, size=256, ttl=300, neg_ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, fetch, now=None):
+        """
+        Return the cached value for key or call fetch() to get it.
+        """
+        if now is None:
+            now = _time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] > now:
+                self.entries.move_to_end(key)
+                (value, error, _) = entry
+                if error is not None:
+                    raise error
+                return value
+        try:
+            value = fetch()
+        except Exception as e:
+            self._put(key, (None, e, now + self.neg_ttl))
+            raise
+        self._put(key, (value, None, now + self.ttl))
+        return value
+
+    def _put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
 
 
 class CatalogCache(object):
     def __init__(self, config):
         self.catalog_url = config.get('catalog-service-url')
-        self.catalog = Catalog(self.catalog_url, token=config['admin_token'])
-        self.module_cache = dict()
+        self.catalog = Catalog(
+            self.catalog_url, token=config['admin_token'],
+            pool_size=config.get('rpc_pool_size', 10),
+            connect_timeout=config.get('rpc_connect_timeout', 10))
+        size = config.get('catalog_memory_size', 256)
+        ttl = config.get('catalog_memory_ttl', 300)
+        neg_ttl = config.get('catalog_negative_ttl', 30)
+        self.module_cache = LookupCache(size, ttl, neg_ttl)
+        self.volume_cache = LookupCache(size, ttl, neg_ttl)
+        self.hints_cache = LookupCache(size, ttl, neg_ttl)
+        self.used = set()
+        # Module version and secure params are fetched side by side
+        self.fetcher = ThreadPoolExecutor(config.get('catalog_workers', 4))
+        # Shared with the other runners on the node if configured
+        self.store = None
+        if config.get('catalog_cache_dir') is not None:
+            path = os.path.join(config['catalog_cache_dir'], 'catalog.db')
+            self.store = CatalogStore(path,
+                                      ttl=config.get('catalog_cache_ttl', 300),
+                                      stale=config.get('catalog_cache_stale',
+                                                       3600))
 
-    def get_volume_mounts(self, module, method, cgroup):
+    def _fetch_volume_mounts(self, module, method, cgroup):
         req = {
             'module_name': module,
             'function_name': method,
@@ -19,23 +91,81 @@ class CatalogCache(object):
         else:
             return []
 
+    def get_volume_mounts(self, module, method, cgroup):
+        key = (module, method, cgroup)
+        vols = self.volume_cache.get(
+            key, lambda: self._fetch_volume_mounts(module, method, cgroup))
+        # Callers may change the mounts
+        return [dict(v) for v in vols]
+
+    def _fetch_resource_hints(self, module, method):
+        # Look up the cpu/memory requests in the client group config
+        req = {'module_name': module, 'function_name': method}
+        groups = []
+        for cg in self.catalog.list_client_group_configs(req):
+            groups.extend(cg.get('client_groups', []))
+        return parse_hints(groups)
+
+    def get_resource_hints(self, module, method):
+        return self.hints_cache.get(
+            (module, method),
+            lambda: self._fetch_resource_hints(module, method))
+
+    def _fetch_module(self, module, version):
+        req = {'module_name': module}
+        if version is not None:
+            req['version'] = version
+        # Lookup secure params while getting the image version
+        sp_req = dict(req)
+        sp_req['load_all_versions'] = 0
+        sp_f = self.fetcher.submit(self.catalog.get_secure_config_params,
+                                   sp_req)
+        module_info = self.catalog.get_module_version(req)
+        module_info['secure_config_params'] = sp_f.result()
+        return module_info
+
+    def _refresh(self, key, module, version):
+        try:
+            self.store.put(key, self._fetch_module(module, version))
+        except Exception:
+            # The stale entry stays until it expires
+            pass
+
+    def _load_module(self, module, version):
+        if self.store is None:
+            return self._fetch_module(module, version)
+        key = '{}:{}'.format(module, version or '')
+        try:
+            (module_info, state) = self.store.get(key)
+            if state == 'stale' and self.store.claim_refresh(key):
+                Thread(target=self._refresh, args=[key, module, version],
+                       daemon=True).start()
+        except sqlite3.Error:
+            module_info = None
+        if module_info is None:
+            module_info = self._fetch_module(module, version)
+            try:
+                self.store.put(key, module_info)
+            except sqlite3.Error:
+                pass
+        return module_info
+
+    def _lookup_module(self, module, version):
+        module_info = self.module_cache.get(
+            (module, version), lambda: self._load_module(module, version))
+        # Copy it since submits run concurrently
+        return dict(module_info)
+
+    def prefetch_module(self, module, version):
+        # Look up the module ahead of time without counting as a use
+        return self._lookup_module(module, version)
+
+    def get_git_commit(self, module, version):
+        return self.prefetch_module(module, version)['git_commit_hash']
+
     def get_module_info(self, module, version):
         # Look up the module info
-        if module not in self.module_cache:
-            req = {'module_name': module}
-            if version is not None:
-                req['version'] = version
-            # Get the image version from the catalog and cache it
-            module_info = self.catalog.get_module_version(req)
-            # Lookup secure params
-            req['load_all_versions'] = 0
-            sp = self.catalog.get_secure_config_params(req)
-            module_info['secure_config_params'] = sp
-            module_info['cached'] = False
-            self.module_cache[module] = module_info
-        else:
-            # Use the cache
-            module_info = self.module_cache[module]
-            module_info['cached'] = True
-
+        module_info = self._lookup_module(module, version)
+        module_info['cached'] = (module, version) in self.used
+        self.used.add((module, version))
         return module_info
@@ -1,116 +1,425 @@
 import docker
-from threading import Thread
-from time import time as _time
-from time import sleep as _sleep
+import os
+import ssl
+import json
+import struct
+import asyncio
+import aiohttp
+from threading import Lock, Event
+from docker.errors import ImageNotFound
+from docker.utils import parse_repository_tag
+from .logmerge import LogMerger
+from .monitor import ContainerMonitor
+
+_HEADER_SIZE = 8
+_STDERR = 2
+# How long a monitor waits for an event before checking on its own
+_EVENT_TIMEOUT = 30
+
+
+def _image_key(image):
+    """
+    Normalize an image name the way docker reports it in events.
+    """
+    if image is None:
+        return None
+    (repo, tag) = parse_repository_tag(image)
+    if tag is None:
+        return repo + ':latest'
+    return image
 
 
 class DockerRunner:
     """
     This class provides the container interface for Docker.
 
+    All containers are watched from a single ContainerMonitor loop.
+    Each one gets a log stream coroutine and exits are picked up from
+    one runner-wide docker events subscription.
     """
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, monitor=None, pulls=None):
         """
-        Inputs: config dictionary, Job ID, and optional logger
+        Inputs: optional logger, optional shared ContainerMonitor and
+        optional PullCoordinator to share pulls with other processes
         """
         self.docker = docker.from_env()
         self.logger = logger
+        self.pulls = pulls
+        if monitor is None:
+            monitor = ContainerMonitor()
+        self.monitor = monitor
         self.containers = []
-        self.threads = []
-        self.log_interval = 1
+        self.watchers = dict()
+        self._session = None
+        self._events = None
+        self._events_lock = Lock()
+        # Image tag -> id index, kept fresh by image events
+        self.images = dict()
+        self._pulls = dict()
+        self._image_lock = Lock()
 
     def _sort_lines_by_time(self, sout, serr):
         """
         This is an internal function to sort and interlace output for NJS.
-        This is not fully implemented yet and sould be rethought.
-        """
-
-        lines_by_time = dict()
-        if len(sout) > 0:
-            ierr = 0
-            for line in sout.decode("utf-8").split('\n'):
-                if len(line) > 0:
-                    (ts, txt) = line.split(maxsplit=1)
-                    if ts not in lines_by_time:
-                        lines_by_time[ts] = []
-                    lines_by_time[ts].append({'line': txt, 'is_error': ierr})
-        if len(serr) > 0:
-            ierr = 1
-            for line in serr.decode("utf-8").split('\n'):
-                if len(line) > 0:
-                    (ts, txt) = line.split(maxsplit=1)
-                    if ts not in lines_by_time:
-                        lines_by_time[ts] = []
-                    lines_by_time[ts].append({'line': txt, 'is_error': ierr})
-        nlines = []
-        for ts in sorted(lines_by_time.keys()):
-            nlines.extend(lines_by_time[ts])
-        return nlines
-
-    def _shepherd(self, c, job_id, queues):
-        last = 1
-        try:
-            dolast = False
+        """
+        return LogMerger().merge(sout, serr)
+
+    def _api_endpoint(self):
+        """
+        Work out where the monitor loop sends raw API requests.
+        Returns the versioned base url and an aiohttp connector.
+        """
+        host = os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock')
+        version = self.docker.api._version
+        if host.startswith('unix://'):
+            conn = aiohttp.UnixConnector(path=host[len('unix://'):],
+                                         limit=0)
+            base = 'http://docker'
+        else:
+            ctx = False
+            scheme = 'http'
+            if os.environ.get('DOCKER_TLS_VERIFY'):
+                scheme = 'https'
+                certs = os.environ.get('DOCKER_CERT_PATH',
+                                       os.path.expanduser('~/.docker'))
+                ctx = ssl.create_default_context(
+                    cafile=os.path.join(certs, 'ca.pem'))
+                ctx.load_cert_chain(os.path.join(certs, 'cert.pem'),
+                                    os.path.join(certs, 'key.pem'))
+            conn = aiohttp.TCPConnector(ssl=ctx, limit=0)
+            base = '{}://{}'.format(scheme, host.split('://', 1)[-1])
+        return ('{}/v{}'.format(base, version), conn)
+
+    async def _get_session(self):
+        if self._session is None:
+            (self.api_url, conn) = self._api_endpoint()
+            # Log and event streams stay open as long as they need to
+            timeout = aiohttp.ClientTimeout(total=None)
+            self._session = aiohttp.ClientSession(connector=conn,
+                                                  timeout=timeout)
+        return self._session
+
+    async def _close_session(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def close(self):
+        """
+        Close the docker API session.  Call this before the monitor is
+        stopped.
+        """
+        if self._session is not None:
+            self.monitor.submit(self._close_session()).result()
+
+    async def _log_stream(self, c):
+        """
+        Follow the container log stream and yield (is_error, data) frames.
+        stdout and stderr share one connection and are told apart by the
+        multiplexed frame header.
+        """
+        session = await self._get_session()
+        params = {'stdout': '1', 'stderr': '1', 'follow': '1',
+                  'timestamps': '1'}
+        url = '{}/containers/{}/logs'.format(self.api_url, c.id)
+        async with session.get(url, params=params) as res:
+            res.raise_for_status()
             while True:
-                now = int(_time())
-                sout = c.logs(stdout=True, stderr=False, since=last, until=now,
-                              timestamps=True)
-                serr = c.logs(stdout=False, stderr=True, since=last, until=now,
-                              timestamps=True)
-                lines = self._sort_lines_by_time(sout, serr)
-                if self.logger is not None:
-                    self.logger.log_lines(lines)
-                last = now
-                if dolast:
-                    break
-                _sleep(self.log_interval)
                 try:
-                    c.reload()
-                    if c.status not in ["created", "runnning"]:
-                        dolast = True
-                except Exception:
-                    dolast = True
+                    header = await res.content.readexactly(_HEADER_SIZE)
+                    (stream, length) = struct.unpack('>BxxxL', header)
+                    if not length:
+                        continue
+                    data = await res.content.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    break
+                yield (1 if stream == _STDERR else 0, data)
+
+    async def _follow_logs(self, c, job_id):
+        merger = LogMerger()
+        async for (is_error, data) in self._log_stream(c):
+            lines = merger.push(is_error, data)
+            if len(lines) > 0 and self.logger is not None:
+                # Log writes can block on disk so keep them off the loop
+                await self.monitor.run_blocking(self.logger.log_lines,
+                                                lines, job_id)
+        # Anything left over didn't end with a newline
+        lines = merger.flush()
+        if len(lines) > 0 and self.logger is not None:
+            await self.monitor.run_blocking(self.logger.log_lines, lines,
+                                            job_id)
+
+    def _start_events(self):
+        """
+        Subscribe to container exit and image events once for the whole
+        runner.  The subscription is made before any container starts so
+        no exit can be missed.
+        """
+        with self._events_lock:
+            if self._events is not None:
+                return
+            try:
+                self._events = self.monitor.submit(self._subscribe()).result()
+            except Exception as e:
+                # Monitors fall back to checking on their own
+                if self.logger is not None:
+                    f = "Warning: docker events unavailable: {}"
+                    self.logger.error(f.format(e))
+
+    async def _subscribe(self):
+        session = await self._get_session()
+        labels = ['job_id']
+        if os.environ.get('CONDOR_ID') is not None:
+            labels.append('condor_id={}'.format(os.environ['CONDOR_ID']))
+        filters = {
+            'type': ['container'],
+            'event': ['die', 'oom', 'destroy'],
+            'label': labels
+        }
+        res = await session.get(self.api_url + '/events',
+                                params={'filters': json.dumps(filters)})
+        res.raise_for_status()
+        # Images don't carry our labels so they need their own stream
+        filters = {
+            'type': ['image'],
+            'event': ['delete', 'untag', 'tag', 'pull', 'load', 'import']
+        }
+        ires = await session.get(self.api_url + '/events',
+                                 params={'filters': json.dumps(filters)})
+        ires.raise_for_status()
+        asyncio.ensure_future(self._watch_events(res, self._handle_event))
+        asyncio.ensure_future(self._watch_events(ires,
+                                                 self._handle_image_event))
+        return res
+
+    async def _watch_events(self, res, handler):
+        try:
+            async for line in res.content:
+                if len(line.strip()) > 0:
+                    handler(json.loads(line.decode('utf-8')))
+        except Exception:
+            pass
+        res.close()
+        # Subscribe again on the next run.  Until then the image index
+        # can't be trusted.
+        with self._events_lock:
+            if self._events is res:
+                self._events = None
+            self.images = dict()
+
+    def _handle_image_event(self, ev):
+        """
+        Drop any index entries an image event could have changed.
+        """
+        name = ev.get('Actor', {}).get('Attributes', {}).get('name')
+        stale = [_image_key(name), _image_key(ev.get('id', ''))]
+        images = self.images
+        for (tag, id) in list(images.items()):
+            if tag in stale or id == ev.get('id'):
+                images.pop(tag, None)
+
+    def _handle_event(self, ev):
+        w = self.watchers.get(ev.get('id'))
+        if w is None:
+            return
+        action = ev.get('Action', ev.get('status'))
+        if action == 'oom':
+            w['oom'] = True
+            return
+        if action == 'die':
+            attrs = ev.get('Actor', {}).get('Attributes', {})
+            w['exit_code'] = int(attrs.get('exitCode', -1))
+        elif action != 'destroy':
+            return
+        w['done'] = True
+        if w['waiter'] is not None and not w['waiter'].done():
+            w['waiter'].set_result(None)
+
+    async def _check_exit(self, c, w):
+        """
+        Look at the container directly.  Returns True if it has stopped.
+        """
+        try:
+            await self.monitor.run_blocking(c.reload)
+        except Exception:
+            # Container is gone
+            return True
+        if c.status in ['created', 'running']:
+            return False
+        state = c.attrs.get('State', {})
+        w['exit_code'] = state.get('ExitCode')
+        w['oom'] = w['oom'] or state.get('OOMKilled', False)
+        return True
+
+    async def _wait_exit(self, c, w):
+        """
+        Wait for the die event.  If none shows up check the container
+        directly in case the event stream was lost.
+        """
+        # Without events nothing else will tell us.  The log stream has
+        # ended so it has most likely stopped already.
+        if not w['done'] and self._events is None and \
+                await self._check_exit(c, w):
+            return
+        while not w['done']:
+            w['waiter'] = self.monitor.loop.create_future()
             try:
-                c.remove()
-            except Exception:
-                # Maybe something already cleaned it up.  Move on.
+                await asyncio.wait_for(w['waiter'], _EVENT_TIMEOUT)
+                continue
+            except asyncio.TimeoutError:
                 pass
-            self.containers.remove(c)
+            if await self._check_exit(c, w):
+                break
+
+    async def _remove(self, c):
+        try:
+            await self.monitor.run_blocking(c.remove)
+        except Exception:
+            # Maybe something already cleaned it up.  Move on.
+            pass
+
+    async def _log_error(self, line):
+        if self.logger is not None:
+            await self.monitor.run_blocking(self.logger.error, line)
+
+    async def _shepherd(self, c, job_id, queues):
+        w = self.watchers[c.id]
+        run_blocking = self.monitor.run_blocking
+        try:
+            try:
+                await self._follow_logs(c, job_id)
+            except Exception as e:
+                f = "Lost log stream for container {}: {}"
+                await self._log_error(f.format(c.id, e))
+            # The stream ends when the container stops
+            await self._wait_exit(c, w)
+            if self.logger is not None:
+                await run_blocking(self.logger.end_stream, job_id)
+            if w['oom']:
+                f = "Container for job {} ran out of memory"
+                await self._log_error(f.format(job_id))
+            elif w['exit_code']:
+                f = "Container for job {} exited with code {}"
+                await self._log_error(f.format(job_id, w['exit_code']))
+            await self._remove(c)
+            if c in self.containers:
+                self.containers.remove(c)
+            self.watchers.pop(c.id, None)
+            info = {'exit_code': w['exit_code'], 'oom': w['oom']}
             for q in queues:
-                q.put(['finished', job_id, None])
+                # A multiprocessing queue can block when its pipe is full
+                await run_blocking(q.put, ['finished', job_id, info])
         except Exception as e:
             if self.logger is not None:
-                self.logger.error("Unexpected failure")
+                await self._log_error("Unexpected failure")
             else:
                 print("Exception in docker logging for %s" % (c.id))
                 raise(e)
 
-    def get_image(self, image):
-        # Pull the image from the hub if we don't have it
-        pulled = False
-        for im in self.docker.images.list():
-            if image in im.tags:
-                id = im.id
-                pulled = True
-                break
-
-        if not pulled:
+    def _pull(self, image):
+        """
+        Pull an image and stream the progress to the job log.
+        """
+        if self.logger is not None:
             self.logger.log("Pulling image {}".format(image))
-            id = self.docker.images.pull(image).id
+        (repo, tag) = parse_repository_tag(image)
+        layers = dict()
+        for ev in self.docker.api.pull(repo, tag=tag, stream=True,
+                                       decode=True):
+            if 'error' in ev:
+                raise OSError("Failed to pull {}: {}".format(image,
+                                                             ev['error']))
+            status = ev.get('status')
+            if self.logger is None or status is None:
+                continue
+            if 'id' not in ev:
+                # Overall status (Digest, Status: Downloaded newer image)
+                self.logger.log(status)
+            elif layers.get(ev['id']) != status and \
+                    status in ['Pull complete', 'Already exists']:
+                layers[ev['id']] = status
+                self.logger.log('{}: {}'.format(ev['id'], status))
+        return self.docker.images.get(image).id
+
+    def _lookup(self, image):
+        try:
+            # Direct lookup by name instead of listing every image
+            return self.docker.images.get(image).id
+        except ImageNotFound:
+            return None
+
+    def _resolve_image(self, image):
+        id = self._lookup(image)
+        if id is not None:
+            return id
+        if self.pulls is None:
+            return self._pull(image)
+        # Let one process on the node do the pull
+        return self.pulls.pull(image, lambda: self._lookup(image),
+                               lambda: self._pull(image))
+
+    def get_image(self, image):
+        """
+        Return the id for an image, pulling it if we don't have it.
+        Concurrent requests for the same image share one lookup/pull.
+        """
+        # The index is only safe to use while image events are watched
+        self._start_events()
+        key = _image_key(image)
+        id = self.images.get(key)
+        if id is not None:
+            return id
+        with self._image_lock:
+            pull = self._pulls.get(key)
+            leader = pull is None
+            if leader:
+                pull = {'event': Event(), 'id': None, 'error': None}
+                self._pulls[key] = pull
+        if not leader:
+            pull['event'].wait()
+            if pull['error'] is not None:
+                raise pull['error']
+            return pull['id']
+        try:
+            id = self._resolve_image(image)
+            if self._events is not None:
+                self.images[key] = id
+            pull['id'] = id
+        except Exception as e:
+            pull['error'] = e
+            raise
+        finally:
+            with self._image_lock:
+                del self._pulls[key]
+            pull['event'].set()
         return id
 
-    def run(self, job_id, image, env, vols, labels, queues):
-        c = self.docker.containers.run(image, 'async',
-                                       environment=env,
-                                       detach=True,
-                                       labels=labels,
-                                       volumes=vols)
+    def run(self, job_id, image, env, vols, labels, queues, limits=None):
+        """
+        Start a container.  limits can hold mem_limit, nano_cpus and
+        cpuset_cpus.
+        """
+        self._start_events()
+        c = self.docker.containers.create(image, 'async',
+                                          environment=env,
+                                          detach=True,
+                                          labels=labels,
+                                          volumes=vols,
+                                          **(limits or {}))
+        # Register before starting so the die event can't be missed
+        self.watchers[c.id] = {'done': False, 'waiter': None,
+                               'exit_code': None, 'oom': False}
+        try:
+            c.start()
+        except Exception:
+            self.watchers.pop(c.id, None)
+            self.remove(c)
+            raise
         self.containers.append(c)
-        # Start a thread to monitor output and handle finished containers
-        t = Thread(target=self._shepherd, args=[c, job_id, queues])
-        self.threads.append(t)
-        t.start()
+        # Hand the container to the monitor loop to follow its output
+        # and report when it finishes
+        self.monitor.submit(self._shepherd(c, job_id, queues))
         return c
 
     def remove(self, c):
@@ -1,17 +1,23 @@
 import os
-from time import sleep as _sleep
+from time import sleep as _sleep, time as _time
 from .logger import Logger
 from clients.NarrativeJobServiceClient import NarrativeJobService as NJS
 from clients.authclient import KBaseAuth
 from .MethodRunner import MethodRunner
-from .callback_server import start_callback_server
+from .callback_server import start_callback_server, serve_inprocess
 from socket import gethostname
 from multiprocessing import Process, Queue
 from .provenance import Provenance
-from queue import Empty
+from queue import Empty, Queue as ThreadQueue
 import socket
 import signal
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread, Event
 from .CatalogCache import CatalogCache
+from .scheduler import SubjobScheduler
+from .memo import SubjobMemo
+from .manifest import parse_entries, load_manifest
+from .resources import NodeResources, ResourceTracker, parse_memory
 
 
 class JobRunner(object):
@@ -25,8 +31,10 @@ class JobRunner(object):
         """
         inputs: config dictionary, NJS URL, Job id, Token, Admin Token
         """
-        self.njs = NJS(url=njs_url, timeout=60)
-        self.logger = Logger(njs_url, job_id, njs=self.njs)
+        self.njs = NJS(url=njs_url, timeout=60,
+                       pool_size=config.get('rpc_pool_size', 10),
+                       connect_timeout=config.get('rpc_connect_timeout', 10))
+        self.logger = Logger(njs_url, job_id, njs=self.njs, config=config)
         self.token = token
         self.client_group = os.environ.get("AWE_CLIENTGROUP", "None")
         self.admin_token = admin_token
@@ -35,13 +43,47 @@ class JobRunner(object):
         self.auth = KBaseAuth(config.get('auth-service-url'))
         self.job_id = job_id
         self.workdir = config.get('workdir', '/mnt/awe/condor')
-        self.jr_queue = Queue()
-        self.callback_queue = Queue()
+        # The callback server can share our loop instead of running in
+        # its own process.  Then nothing needs to be pickled.
+        self.inprocess = config.get('callback_inprocess', False)
+        if self.inprocess:
+            self.jr_queue = ThreadQueue()
+            self.callback_queue = ThreadQueue()
+        else:
+            self.jr_queue = Queue()
+            self.callback_queue = Queue()
         self.prov = None
         self._init_callback_url()
         self.mr = MethodRunner(self.config, job_id, logger=self.logger)
         self.cc = CatalogCache(config)
         self.max_task = config.get('max_tasks', 20)
+        self.resources = None
+        if config.get('resource_admission', True):
+            default = {
+                'cpus': config.get('subjob_cpus', 0),
+                'memory': parse_memory(config.get('subjob_memory', 0))
+            }
+            node = NodeResources(self.config['cgroup'])
+            self.resources = ResourceTracker(node, default=default)
+        self.scheduler = SubjobScheduler(
+            self.max_task, config.get('max_queued', 1000),
+            config.get('subjob_queue_timeout', 120),
+            config.get('subjob_order', 'fifo'), resources=self.resources)
+        # Identical calls to these modules/methods share one container
+        self.memo = SubjobMemo(config.get('memoize', []))
+        # Cancel checks run on their own timer and back off while the
+        # job is quiet
+        self.cancel_interval = config.get('cancel_check_interval', 10)
+        self.cancel_max_interval = config.get('cancel_check_max_interval',
+                                              60)
+        self.canceled = Event()
+        # Set once containers are being torn down so late submits stop
+        self._stopping = Event()
+        self._activity = False
+        self._poller_stop = Event()
+        # Subjob submits run here so _watch never blocks on a pull
+        self.submitter = ThreadPoolExecutor(config.get('submit_workers', 4))
+        self._prov_lock = Lock()
         signal.signal(signal.SIGINT, self.shutdown)
 
     def _init_config(self, config, job_id, njs_url):
@@ -70,6 +112,22 @@ class JobRunner(object):
             return False
         return True
 
+    def _poll_cancel(self):
+        """
+        Check for cancellation in the background.  The interval grows
+        while nothing happens in the job and drops back on activity.
+        """
+        interval = self.cancel_interval
+        while not self._poller_stop.wait(interval):
+            if not self._check_job_status():
+                self.canceled.set()
+                return
+            if self._activity:
+                self._activity = False
+                interval = self.cancel_interval
+            else:
+                interval = min(interval * 2, self.cancel_max_interval)
+
     def _init_workdir(self):
         # Check to see for existence of /mnt/awe/condor
         if not os.path.exists(self.workdir):
@@ -92,6 +150,10 @@ class JobRunner(object):
     def _submit(self, config, job_id, data, subjob=True):
         (module, method) = data['method'].split('.')
         version = data.get('service_ver')
+        # The volume mounts don't depend on the module info
+        vm_f = self.mr.stages.submit(self.cc.get_volume_mounts, module,
+                                     method, self.client_group)
+        hints_f = self.mr.stages.submit(self._resource_hints, module, method)
         module_info = self.cc.get_module_info(module, version)
 
         git_url = module_info['git_url']
@@ -106,15 +168,148 @@ class JobRunner(object):
             f += 'commit: {} version: {} release: release'
             self.logger.error(f.format(module, git_url, git_commit, version))
 
-        vm = self.cc.get_volume_mounts(module, method, self.client_group)
-        config['volume_mounts'] = vm
+        # Each submit gets its own copy since they run concurrently
+        config = dict(config)
+        config['volume_mounts'] = vm_f.result()
+        if self._stopping.is_set():
+            raise OSError("Job canceled")
         action = self.mr.run(config, module_info, data, job_id,
                              callback=self.callback_url, subjob=subjob,
-                             fin_q=self.jr_queue)
+                             fin_q=self.jr_queue, resources=hints_f.result())
+        if self._stopping.is_set():
+            # Started while the others were being cleaned up
+            self.mr.cleanup_all()
+            raise OSError("Job canceled")
         self._update_prov(action)
 
+    def _submit_async(self, config, job_id, data):
+        """
+        Run a subjob submit off the _watch thread.  A failure is reported
+        back as the subjob finishing with an error.
+        """
+        try:
+            self._submit(config, job_id, data)
+        except Exception as e:
+            f = "Failed to submit subjob {}: {}"
+            self.logger.error(f.format(job_id, e))
+            self.jr_queue.put(['finished', job_id, {'error': str(e)}])
+
+    def _queue_failed(self, job_id, future):
+        e = future.exception()
+        if e is not None:
+            f = "Failed to queue subjob {}: {}"
+            self.logger.error(f.format(job_id, e))
+            self.jr_queue.put(['finished', job_id,
+                               {'error': str(e), 'started': False}])
+
+    def _queue_subjob(self, job_id, data):
+        """
+        Look up the resources a subjob asks for and any memoized result
+        off the _watch thread and then queue it.
+        """
+        hints = None
+        if len(data.get('method', '').split('.')) == 2:
+            (module, method) = data['method'].split('.')
+            if self.resources is not None:
+                hints = self._resource_hints(module, method)
+            if self.memo.allowed(data['method']) and \
+                    not self._memoize(job_id, module, data):
+                return
+        self.jr_queue.put(['queue', job_id, [data, hints]])
+
+    def _memoize(self, job_id, module, data):
+        """
+        Returns True if the subjob has to run.  Otherwise it gets the
+        result of an identical call once that is there.
+        """
+        try:
+            commit = self.cc.get_git_commit(module, data.get('service_ver'))
+        except Exception as e:
+            f = "Warning: not memoizing {}: {}"
+            self.logger.error(f.format(data['method'], e))
+            return True
+        key = self.memo.key(data['method'], commit, data.get('params'))
+        (state, result) = self.memo.claim(key, job_id)
+        if state == 'hit':
+            self.logger.log('Using memoized result for {}'.format(job_id))
+            self.jr_queue.put(['finished', job_id, {'memo': result}])
+        return state == 'run'
+
+    def _resource_hints(self, module, method):
+        try:
+            return self.cc.get_resource_hints(module, method)
+        except Exception as e:
+            f = "Warning: no resource hints for {}.{}: {}"
+            self.logger.error(f.format(module, method, e))
+            return None
+
+    def _prefetch_entries(self):
+        entries = parse_entries(','.join(self.config.get('prefetch_modules',
+                                                         [])))
+        path = self.config.get('module_manifest')
+        if path is not None:
+            try:
+                entries.extend(load_manifest(path))
+            except (IOError, OSError) as e:
+                f = "Warning: can't read module manifest {}: {}"
+                self.logger.error(f.format(path, e))
+        return entries
+
+    def _prefetch(self):
+        """
+        Look up catalog info, volume mounts and images for the modules
+        the job is expected to call while the main container starts.
+        """
+        entries = self._prefetch_entries()
+        if len(entries) == 0:
+            return None
+        self.logger.log('Prefetching {} modules'.format(len(entries)))
+        pool = ThreadPoolExecutor(self.config.get('prefetch_workers', 4))
+        for (module, method, version) in entries:
+            pool.submit(self._prefetch_module, module, method, version)
+        pool.shutdown(wait=False)
+        return pool
+
+    def _prefetch_module(self, module, method, version):
+        try:
+            module_info = self.cc.prefetch_module(module, version)
+            if method is not None:
+                self.cc.get_volume_mounts(module, method, self.client_group)
+                if self.resources is not None:
+                    self.cc.get_resource_hints(module, method)
+            self.mr.runner.get_image(module_info['docker_img_name'])
+        except Exception as e:
+            f = "Warning: prefetch of {} failed: {}"
+            self.logger.error(f.format(module, e))
+
+    def _output_ref(self, job_id):
+        # Runs on the stage pool
+        try:
+            output = self.mr.get_output_ref(job_id)
+        except Exception as e:
+            output = {'error': {
+                'code': -32601,
+                'name': 'Failed to read job output',
+                'message': str(e),
+                'error': str(e)
+            }}
+        # The callback server streams it from the file
+        mtype = 'output_ref' if 'path' in output else 'output'
+        self.jr_queue.put(['output_ready', job_id, [mtype, output]])
+
+    def _deliver(self, job_id, mtype, output):
+        self.callback_queue.put([mtype, job_id, output])
+        # Errors aren't cached but waiting duplicates get them
+        cache = 'error' not in output and not output.get('failed', False)
+        for dup in self.memo.complete(job_id, [mtype, output], cache=cache):
+            self.jr_queue.put(['finished', dup, {'memo': [mtype, output]}])
+
     def _cancel(self):
-        self.mr.cleanup_all()
+        self._stopping.set()
+        start = _time()
+        removed = self.mr.cleanup_all()
+        f = 'Cleaned up {} containers in {:.3f}s'
+        self.logger.log(f.format(removed, _time() - start))
 
     def shutdown(self, sig, bt):
         print("Recieved an interupt")
@@ -129,20 +324,64 @@ class JobRunner(object):
         while cont:
             try:
                 req = self.jr_queue.get(timeout=1)
-                if req[0] == 'submit':
-                    if ct > self.max_task:
+                # Check for cancels more often while subjobs come and go
+                self._activity = True
+                add = []
+                if req[0] == 'submit_batch':
+                    add = [(job_id, data, None) for (job_id, data) in req[2]]
+                elif req[0] == 'submit':
+                    add = [(req[1], req[2], None)]
+                elif req[0] == 'queue':
+                    add = [(req[1], req[2][0], req[2][1])]
+                for (job_id, data, hints) in add:
+                    if req[0] != 'queue' and \
+                            (self.resources is not None or
+                             self.memo.allowed(data.get('method', ''))):
+                        # Queued once its resource hints are known
+                        qf = self.mr.stages.submit(self._queue_subjob,
+                                                   job_id, data)
+                        qf.add_done_callback(
+                            lambda f, job_id=job_id:
+                                self._queue_failed(job_id, f))
+                    # Started below once there is a free slot
+                    elif not self.scheduler.add(job_id, data, hints=hints):
                         self.logger.error("Too many subtasks")
                         self._cancel()
                         return {'error': 'Canceled or unexpected error'}
-                    self._submit(config, req[1], req[2])
-                    ct += 1
+                if req[0] == 'output_ready':
+                    (mtype, output) = req[2]
+                    self._deliver(req[1], mtype, output)
                 elif req[0] == 'finished':
                     subjob = True
                     job_id = req[1]
                     if job_id == self.job_id:
                         subjob = False
-                    output = self.mr.get_output(job_id, subjob=subjob)
-                    self.callback_queue.put(['output', job_id, output])
+                    else:
+                        self.scheduler.finished(job_id)
+                    self.mr.finished(job_id)
+                    info = req[2] or {}
+                    mtype = 'output'
+                    output = None
+                    if 'memo' in info or not info.get('started', True):
+                        # Never had a container
+                        ct += 1
+                    if 'memo' in info:
+                        (mtype, output) = info['memo']
+                    elif 'error' in info:
+                        output = {'error': {
+                            'code': -32601,
+                            'name': 'Failed to start job',
+                            'message': info['error'],
+                            'error': info['error']
+                        }}
+                    elif subjob:
+                        # Hashing a big output would hold up this loop.
+                        # It comes back as output_ready.
+                        self.mr.stages.submit(self._output_ref, job_id)
+                    else:
+                        output = self.mr.get_output(job_id, subjob=subjob)
+                    if output is not None:
+                        self._deliver(job_id, mtype, output)
                     ct -= 1
                     if not subjob:
                         if ct > 0:
@@ -150,20 +389,40 @@ class JobRunner(object):
                             self.logger.error(err)
                         return output
                 elif req[0] == 'cancel':
+                    self.logger.error("Job canceled")
                     self._cancel()
                     return {}
             except Empty:
                 pass
+            for (job_id, data, wait) in self.scheduler.ready():
+                if wait >= 1:
+                    f = 'Subjob {} waited {:.1f}s for a free slot'
+                    self.logger.log(f.format(job_id, wait))
+                self.submitter.submit(self._submit_async, config,
+                                      job_id, data)
+                ct += 1
             if ct == 0:
                 # This shouldn't happen
                 return
-            # Run cancellation / finish job checker
-            if not self._check_job_status():
+            # Set by the cancellation poller
+            if self.canceled.is_set():
                 self.logger.error("Job canceled or unexpected error")
                 self._cancel()
                 _sleep(5)
                 return {'error': 'Canceled or unexpected error'}
 
+    def _output_conf(self):
+        """
+        Settings for the callback server's output store.
+        """
+        spill_dir = os.path.join(self.workdir, 'outputs')
+        os.makedirs(spill_dir, exist_ok=True)
+        return {
+            'budget': self.config.get('output_budget', 256*1024*1024),
+            'grace': self.config.get('output_grace', 300),
+            'spill_dir': spill_dir
+        }
+
     def _init_callback_url(self):
         # Find a free port and Start up callback server
         if os.environ.get('CALLBACK_IP') is not None:
@@ -184,8 +443,9 @@ class JobRunner(object):
         self.callback_url = url
 
     def _update_prov(self, action):
-        self.prov.add_subaction(action)
-        self.callback_queue.put(['prov', None, self.prov.get_prov()])
+        with self._prov_lock:
+            self.prov.add_subaction(action)
+            self.callback_queue.put(['prov', None, self.prov.get_prov()])
 
     def _validate_token(self):
         # Validate token and get user name
@@ -239,18 +499,49 @@ class JobRunner(object):
         self.prov = Provenance(params)
 
         # Start the callback server
-        cb_args = [self.ip, self.port, self.jr_queue, self.callback_queue,
-                   self.token]
-        cbs = Process(target=start_callback_server, args=cb_args)
-        cbs.start()
+        output_conf = self._output_conf()
+        if self.inprocess:
+            cbs = self.mr.monitor.submit(serve_inprocess(
+                self.ip, self.port, self.jr_queue, self.token,
+                self.config.get('cancel_token'), output_conf)).result()
+            (cbs, self.callback_queue) = cbs
+        else:
+            cb_args = [self.ip, self.port, self.jr_queue,
+                       self.callback_queue, self.token,
+                       self.config.get('cancel_token'), output_conf]
+            cbs = Process(target=start_callback_server, args=cb_args)
+            cbs.start()
+
+        # Warm up for known subjobs while the main job starts
+        self._prefetch()
 
         # Submit the main job
         self._submit(config, self.job_id, params, subjob=False)
 
+        poller = Thread(target=self._poll_cancel, daemon=True)
+        poller.start()
         output = self._watch(config)
+        self._poller_stop.set()
 
-        cbs.kill()
+        if self.inprocess:
+            self.mr.monitor.loop.call_soon_threadsafe(cbs.close)
+        else:
+            cbs.kill()
+        m = self.scheduler.metrics()
+        if m['started'] > 0:
+            f = 'Subjobs: {} started, max queue depth {}, '
+            f += 'wait avg {:.1f}s max {:.1f}s'
+            self.logger.log(f.format(m['started'], m['max_depth'],
+                                     m['avg_wait'], m['max_wait']))
+        m = self.memo.stats
+        if m['hits'] + m['collapsed'] > 0:
+            f = 'Memoized subjobs: {} hits, {} collapsed, {} misses'
+            self.logger.log(f.format(m['hits'], m['collapsed'], m['misses']))
+        self.submitter.shutdown(wait=False)
+        self.mr.close()
         self.logger.log('Job is done')
+        # Make sure all the job logs are in before marking it finished
+        self.logger.close()
         self.njs.finish_job(self.job_id, output)
         # TODO: Attempt to clean up any running docker containers
         #       (if something crashed, for example)
@@ -1,9 +1,38 @@
 from .DockerRunner import DockerRunner
 from .ShifterRunner import ShifterRunner
+from .monitor import ContainerMonitor
+from .pullcoord import PullCoordinator
+from .resources import CpusetAllocator, parse_memory
 import os
+import re
 import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime, timezone
+from math import ceil
+
+_ERROR_CHECK_SIZE = 1024*1024
+_ERROR_SCAN_SIZE = 64*1024
+_JSON_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+
+def _has_error_key(head):
+    """
+    Check the start of a JSON document for an error key in the top level
+    object.
+    """
+    depth = 0
+    for m in _JSON_TOKEN.finditer(head):
+        tok = m.group()
+        if tok in (b'{', b'['):
+            depth += 1
+        elif tok in (b'}', b']'):
+            depth -= 1
+        elif depth == 1 and tok == b'"error"' and \
+                head[m.end():m.end() + 64].lstrip().startswith(b':'):
+            return True
+    return False
+
 
 # Write out config file with all kbase endpoints / secure params
 
@@ -29,23 +58,38 @@ class MethodRunner:
         self.refbase = config.get('refdata_dir', '/tmp/ref')
         self.job_dir = os.path.join(self.workdir, 'workdir')
         runtime = config.get('runtime', 'docker')
-        self.containers = []
+        # Running containers by job id
+        self.containers = dict()
+        if runtime not in ['docker', 'shifter']:
+            raise OSError("Unknown runtime")
+        # Slow submit stages (image pulls, catalog calls) run here so they
+        # can overlap
+        self.stages = ThreadPoolExecutor(config.get('stage_workers', 8))
+        # Containers that ask for CPUs get their own cores.  Off by
+        # default since other runners on the node hand out the same ones.
+        self.cpusets = None
+        if config.get('cpuset_pinning', False):
+            self.cpusets = CpusetAllocator()
+        # One loop watches every container for this job
+        self.monitor = ContainerMonitor(config.get('monitor_workers', 4))
         if runtime == 'docker':
-            self.runner = DockerRunner(logger=logger)
-        elif runtime == 'shifter':
-            self.runner = ShifterRunner(logger=logger)
+            # Image pulls are shared with other runners on the node
+            pulls = PullCoordinator(
+                config.get('image_lock_dir', '/tmp/jr_image_locks'),
+                config.get('max_image_pulls', 2))
+            self.runner = DockerRunner(logger=logger, monitor=self.monitor,
+                                       pulls=pulls)
         else:
-            raise OSError("Unknown runtime")
+            self.runner = ShifterRunner(logger=logger, monitor=self.monitor)
 
     def _init_workdir(self, config, job_dir, params):
         # Create all the directories
         # if not os.path.exists(self.basedir):
         #     os.mkdir(self.basedir)
-        if not os.path.exists(self.job_dir):
-            os.mkdir(self.job_dir)
+        # Subjobs set up their work areas concurrently
+        os.makedirs(self.job_dir, exist_ok=True)
         self.subjobdir = os.path.join(self.workdir, 'subjobs')
-        if not os.path.exists(self.subjobdir):
-            os.mkdir(self.subjobdir)
+        os.makedirs(self.subjobdir, exist_ok=True)
         # Create config.properties and inputs
         conf_prop = ConfigParser()
 
@@ -103,12 +147,50 @@ class MethodRunner:
         else:
             return self.job_dir
 
+    def _limits(self, job_id, hints):
+        """
+        Work out the container CPU and memory limits from the module's
+        resource hints, falling back to the config.  The catalog numbers
+        are requests, not maximums, so only container_cpus caps CPUs and
+        the memory hint is only a hard limit with hint_memory_limit set.
+        The CPU hint still sizes the cpuset when pinning.
+        """
+        hints = hints or {}
+        cap = self.config.get('container_cpus')
+        cpus = hints.get('cpus', cap)
+        memory = None
+        if self.config.get('hint_memory_limit', False):
+            memory = hints.get('memory')
+        if memory is None and self.config.get('container_memory'):
+            memory = parse_memory(self.config['container_memory'])
+        limits = dict()
+        if memory:
+            limits['mem_limit'] = int(memory)
+        if cap:
+            limits['nano_cpus'] = int(float(cap) * 1e9)
+        if cpus:
+            if self.cpusets is not None:
+                cpuset = self.cpusets.allocate(job_id, int(ceil(float(cpus))))
+                # If the cores are all taken it just runs unpinned
+                if cpuset is not None:
+                    limits['cpuset_cpus'] = ','.join(str(c) for c in cpuset)
+        return limits
+
+    def finished(self, job_id):
+        """
+        Give back anything the job's container was holding.
+        """
+        self.containers.pop(job_id, None)
+        if self.cpusets is not None:
+            self.cpusets.release(job_id)
+
     def run(self, config, module_info, params, job_id, fin_q=None,
-            callback=None, subjob=False):
+            callback=None, subjob=False, resources=None):
         """
         Run the method.  This is used for subjobs too.
         This is a blocking call.  It will not return until the
         job/process exits.
+        resources are the module's cpus/memory hints, if any.
         """
         # Mkdir workdir/tmp
         job_dir = self._get_job_dir(job_id, subjob=subjob)
@@ -118,10 +200,8 @@ class MethodRunner:
         version = params.get('service_ver')
 
         image = module_info['docker_img_name']
-        id = self.runner.get_image(image)
-
-        if id is None:
-            self.logger.error("No id returned for image")
+        # Pull the image while the work area is set up
+        image_f = self.stages.submit(self.runner.get_image, image)
 
         if subjob:
             fstr = 'Subjob method: {} JobID: {}'
@@ -191,9 +271,19 @@ class MethodRunner:
             'code_url': module_info['git_url'],
             'commit': module_info['git_commit_hash']
         }
+        id = image_f.result()
+        if id is None:
+            self.logger.error("No id returned for image")
+
+        limits = self._limits(job_id, resources)
         # Do we need to do more for error handling?
-        c = self.runner.run(job_id, image, env, vols, labels, [fin_q])
-        self.containers.append(c)
+        try:
+            c = self.runner.run(job_id, image, env, vols, labels, [fin_q],
+                                limits=limits)
+        except Exception:
+            self.finished(job_id)
+            raise
+        self.containers[job_id] = c
         return action
 
     def get_output(self, job_id, subjob=True, max_size=1024*1024*1024):
@@ -232,10 +322,63 @@ class MethodRunner:
 
         return output
 
-    def cleanup_all(self):
-        for c in self.containers:
+    def get_output_ref(self, job_id, subjob=True, max_size=1024*1024*1024):
+        """
+        Like get_output but return a reference to the output file (path,
+        size and sha256 digest) instead of loading it.  Missing or too
+        big output comes back as the same error output.  failed is set if
+        the method returned an error.
+        """
+        of = os.path.join(self._get_job_dir(job_id, subjob=subjob),
+                          'output.json')
+        if not os.path.exists(of) or os.stat(of).st_size > max_size:
+            return self.get_output(job_id, subjob=subjob, max_size=max_size)
+        size = os.stat(of).st_size
+        digest = hashlib.sha256()
+        with open(of, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        failed = False
+        if size <= _ERROR_CHECK_SIZE:
             try:
-                self.runner.remove(c)
-            except OSError:
-                continue
-        return True
+                with open(of) as json_file:
+                    failed = 'error' in json.load(json_file)
+            except ValueError:
+                failed = True
+        else:
+            # Too big to load, so look for a top level error key near
+            # the start
+            with open(of, 'rb') as f:
+                failed = _has_error_key(f.read(_ERROR_SCAN_SIZE))
+        if failed:
+            self.logger.error("Error in job")
+        return {'path': of, 'size': size, 'digest': digest.hexdigest(),
+                'failed': failed}
+
+    def close(self):
+        """
+        Release the runner, the monitor loop and the stage pool once the
+        job is done.
+        """
+        self.runner.close()
+        self.monitor.stop()
+        self.stages.shutdown(wait=False)
+
+    def _remove(self, c):
+        try:
+            self.runner.remove(c)
+            return True
+        except OSError:
+            return False
+
+    def cleanup_all(self):
+        """
+        Kill and remove the containers that are still running.
+        Returns how many were removed.
+        """
+        containers = list(self.containers.values())
+        if len(containers) == 0:
+            return 0
+        # Kill them all at once instead of waiting on each in turn
+        with ThreadPoolExecutor(min(32, len(containers))) as pool:
+            return sum(pool.map(self._remove, containers))
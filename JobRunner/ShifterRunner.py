@@ -1,43 +1,82 @@
 import os
-from threading import Thread
+import asyncio
+from shutil import which
 from subprocess import Popen, PIPE
-from select import select
+from .monitor import ContainerMonitor
 
 
 class ShifterRunner:
     """
-    This class provides the container interface for Docker.
+    This class provides the container interface for Shifter.
 
+    Process output is read from the shared ContainerMonitor loop.
     """
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, monitor=None):
         """
-        Inputs: config dictionary, Job ID, and optional logger
+        Inputs: optional logger and optional shared ContainerMonitor
         """
         self.logger = logger
+        if monitor is None:
+            monitor = ContainerMonitor()
+        self.monitor = monitor
         self.containers = []
-        self.threads = []
 
-    def _readio(self, p, job_id, queues):
-        cont = True
-        last = False
-        while cont:
-            rlist = [p.stdout, p.stderr]
-            x = select(rlist, [], [], 1)[0]
-            for f in x:
-                if f == p.stderr:
-                    error = True
-                else:
-                    error = False
-                line = f.readline().decode('utf-8')
-                if len(line) > 0:
-                    self.logger.log_lines([{'line': line, 'error': error}])
-            if last:
-                cont = False
-            if p.poll() is not None:
-                last = True
+    def close(self):
+        """
+        Nothing to release for Shifter.
+        """
+        pass
+
+    async def _readio(self, p, job_id, queues):
+        loop = self.monitor.loop
+        done = loop.create_future()
+        streams = {p.stdout.fileno(): 0, p.stderr.fileno(): 1}
+        partial = dict()
+        writes = {'last': None}
+
+        async def _write(prev, lines):
+            # Log writes can block on disk so keep them off the loop
+            # but in the order they were read
+            if prev is not None:
+                await prev
+            await self.monitor.run_blocking(self.logger.log_lines, lines,
+                                            job_id)
+
+        def _emit(data, is_error):
+            text = data.decode('utf-8', 'replace')
+            lines = [{'line': line, 'is_error': is_error}
+                     for line in text.split('\n') if len(line) > 0]
+            if len(lines) > 0:
+                writes['last'] = asyncio.ensure_future(
+                    _write(writes['last'], lines), loop=loop)
+
+        def _read(fd):
+            is_error = streams[fd]
+            data = os.read(fd, 65536)
+            if len(data) == 0:
+                loop.remove_reader(fd)
+                del streams[fd]
+                _emit(partial.pop(fd, b''), is_error)
+                if len(streams) == 0 and not done.done():
+                    done.set_result(None)
+                return
+            data = partial.get(fd, b'') + data
+            end = data.rfind(b'\n') + 1
+            partial[fd] = data[end:]
+            _emit(data[:end], is_error)
+
+        for fd in list(streams.keys()):
+            loop.add_reader(fd, _read, fd)
+        await done
+        if writes['last'] is not None:
+            await writes['last']
+        await self.monitor.run_blocking(p.wait)
+        await self.monitor.run_blocking(self.logger.end_stream, job_id)
+        info = {'exit_code': p.returncode, 'oom': False}
         for q in queues:
-            q.put(['finished', job_id, None])
+            await self.monitor.run_blocking(q.put,
+                                            ['finished', job_id, info])
 
     def get_image(self, image):
         # Do a shifterimg images
@@ -55,19 +94,29 @@ class ShifterRunner:
 
         return id
 
-    def run(self, job_id, image, env, vols, labels, queues):
+    def _command(self, image, limits):
+        """
+        Build the shifter command.  Shifter has no resource flags so CPU
+        pinning is done by running it under taskset.  Memory isn't
+        limited since the only per-process limit is on address space.
+        """
         cmd = [
             'shifter',
             '--image=%s' % (image)
             ]
+        cpuset = (limits or {}).get('cpuset_cpus')
+        if cpuset and which('taskset') is not None:
+            cmd = ['taskset', '-c', cpuset] + cmd
+        return cmd
+
+    def run(self, job_id, image, env, vols, labels, queues, limits=None):
+        cmd = self._command(image, limits)
         # Should we do somehting with the labels?
         newenv = os.environ
         for e in env.keys():
             newenv[e] = env[e]
         proc = Popen(cmd, bufsize=0, stdout=PIPE, stderr=PIPE, env=newenv)
-        out = Thread(target=self._readio, args=[proc, job_id, queues])
-        self.threads.append(out)
-        out.start()
+        self.monitor.submit(self._readio(proc, job_id, queues))
         self.containers.append(proc)
         return proc
 
@@ -1,51 +1,318 @@
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import json, stream
 from sanic.exceptions import abort
 import uuid
+import hmac
+import os
+import json as _json
+from functools import partial
+from .outputstore import OutputStore, OutputRef
 from queue import Empty
 import asyncio
+import multiprocessing.queues
 
 app = Sanic()
-outputs = dict()
+outputs = OutputStore()
 prov = None
+# Futures for calls waiting on a job's output
+waiters = dict()
+# How many calls wait on each job so unused waiters can be dropped
+waiting = dict()
+_CHUNK = 65536
+# Longest a _check_job call may wait for the job to finish
+_MAX_CHECK_WAIT = 60
+# Stands in for output files in a response until they are streamed
+_PLACEHOLDER = '__jr_output_file_{}_'.format(uuid.uuid4().hex)
 
 
-def _check_finished():
+class LoopQueue(object):
+    """
+    This class stands in for the in_q when the server runs in-process.
+    put() hands the message straight to the server's loop so nothing is
+    pickled or polled.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def put(self, msg):
+        self.loop.call_soon_threadsafe(_deliver, *msg)
+
+
+def _deliver(mtype, fjob_id, output):
     global prov
+    if mtype in ['output', 'output_ref']:
+        if mtype == 'output_ref':
+            output = OutputRef(output)
+        outputs.put(fjob_id, output)
+        f = waiters.pop(fjob_id, None)
+        if f is not None and not f.done():
+            f.set_result(output)
+    elif mtype == 'prov':
+        prov = output
+
+
+def _check_finished():
     in_q = app.config['in_q']
+    if isinstance(in_q, LoopQueue):
+        # Messages are delivered as they are sent
+        return
     try:
         # Flush the queue
         while True:
             [mtype, fjob_id, output] = in_q.get(block=False)
-            if mtype == 'output':
-                outputs[fjob_id] = output
-            elif mtype == 'prov':
-                prov = output
+            _deliver(mtype, fjob_id, output)
     except Empty:
         pass
 
 
+def _event_driven():
+    """
+    True if outputs are delivered to waiters as they arrive.  Otherwise
+    waiters have to poll the queue.
+    """
+    return isinstance(app.config['in_q'], LoopQueue) or \
+        app.config.get('draining', False)
+
+
+async def _drain(in_q):
+    """
+    Move messages from the multiprocessing queue onto the loop as they
+    come in so waiting calls are woken right away.
+    """
+    loop = asyncio.get_event_loop()
+    app.config['draining'] = True
+    while True:
+        try:
+            msg = await loop.run_in_executor(None, in_q.get, True, 1)
+        except Empty:
+            continue
+        _deliver(*msg)
+
+
+@app.listener('after_server_start')
+async def _start_drain(app, loop):
+    in_q = app.config.get('in_q')
+    if isinstance(in_q, multiprocessing.queues.Queue):
+        loop.create_task(_drain(in_q))
+
+
+async def _wait_outputs(job_ids, timeout=None, first=False):
+    """
+    Wait for all (or with first, any) of the jobs to finish or for
+    timeout to run out.
+    """
+    watched = set(job_ids)
+    for job_id in watched:
+        waiting[job_id] = waiting.get(job_id, 0) + 1
+    try:
+        await _wait_loop(job_ids, timeout, first)
+    finally:
+        for job_id in watched:
+            waiting[job_id] -= 1
+            if waiting[job_id] > 0:
+                continue
+            del waiting[job_id]
+            # Nobody is waiting on it anymore.  It may never finish.
+            f = waiters.get(job_id)
+            if f is not None and not f.done():
+                waiters.pop(job_id)
+                f.cancel()
+
+
+async def _wait_loop(job_ids, timeout, first):
+    loop = asyncio.get_event_loop()
+    deadline = None
+    if timeout is not None:
+        deadline = loop.time() + timeout
+    _check_finished()
+    while True:
+        pending = [j for j in job_ids if j not in outputs]
+        if len(pending) == 0 or (first and len(pending) < len(job_ids)):
+            return
+        wait = None
+        if deadline is not None:
+            wait = deadline - loop.time()
+            if wait <= 0:
+                return
+        if not _event_driven():
+            wait = 1 if wait is None else min(wait, 1)
+        futures = []
+        for job_id in pending:
+            if job_id not in waiters:
+                waiters[job_id] = loop.create_future()
+            # Shielded since other calls may wait on the same job
+            futures.append(asyncio.shield(waiters[job_id]))
+        when = asyncio.FIRST_COMPLETED if first else asyncio.ALL_COMPLETED
+        await asyncio.wait(futures, timeout=wait, return_when=when)
+        _check_finished()
+
+
+async def _wait_output(job_id, timeout=None):
+    """
+    Wait for a job's output.  Returns None if timeout runs out first.
+    """
+    await _wait_outputs([job_id], timeout=timeout)
+    if job_id in outputs:
+        return outputs.get(job_id)
+    return None
+
+
+def _object_bounds(path):
+    """
+    Find the offset of the brace that closes the JSON object in path and
+    whether the object is empty.  Returns None if it isn't an object.
+    """
+    size = os.stat(path).st_size
+    with open(path, 'rb') as f:
+        head = f.read(_CHUNK).lstrip()
+        f.seek(max(0, size - _CHUNK))
+        tail = f.read()
+    body = tail.rstrip()
+    if not head.startswith(b'{') or not body.endswith(b'}'):
+        return None
+    end = size - (len(tail) - len(body)) - 1
+    return (end, head[1:].lstrip().startswith(b'}'))
+
+
+def _finish(output, refs, **extra):
+    """
+    Set the finished flag (and any extra fields) on an output.  Output
+    files are left where they are.  A placeholder takes their place and
+    _response streams the file in.
+    """
+    extra['finished'] = True
+    if isinstance(output, OutputRef):
+        bounds = _object_bounds(output.path)
+        if bounds is not None:
+            key = '{}{}'.format(_PLACEHOLDER, len(refs))
+            refs.append((key, output, bounds, extra))
+            return key
+        with open(output.path) as f:
+            output = _json.load(f)
+    output = dict(output)
+    output.update(extra)
+    return output
+
+
+async def _send(body, refs, response):
+    for (key, output, (end, empty), extra) in refs:
+        (before, body) = body.split(_json.dumps(key), 1)
+        await response.write(before.encode('utf-8'))
+        with open(output.path, 'rb') as f:
+            left = end
+            while left > 0:
+                chunk = f.read(min(_CHUNK, left))
+                if len(chunk) == 0:
+                    break
+                left -= len(chunk)
+                await response.write(chunk)
+        # Add the extra fields in place of the closing brace
+        fields = ', '.join('"{}": {}'.format(k, _json.dumps(v))
+                           for (k, v) in extra.items())
+        await response.write(((' ' if empty else ', ') + fields + '}')
+                             .encode('utf-8'))
+    await response.write(body.encode('utf-8'))
+
+
+def _response(result, refs):
+    """
+    Return result as is if it holds no output files.  Otherwise stream
+    it with the files filled in.
+    """
+    if len(refs) == 0:
+        return result
+    headers = dict()
+    if len(refs) == 1:
+        headers['X-Output-Digest'] = refs[0][1].digest
+    fn = partial(_send, _json.dumps(result), refs)
+    return stream(fn, headers=headers, content_type='application/json')
+
+
+def _wait_param(value):
+    if value is None:
+        return 0
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        abort(400)
+    return min(value, app.config.get('max_check_wait', _MAX_CHECK_WAIT))
+
+
 async def _process_rpc(data, token):
     (module, method) = data['method'].split('.')
+    refs = []
+    # batch submit: a list of {method, params, service_ver} calls
+    if method == '_submit_batch':
+        if token != app.config.get('token'):
+            abort(401)
+        if 'params' not in data:
+            abort(404)
+        calls = None
+        if isinstance(data['params'], list) and len(data['params']) > 0:
+            calls = data['params'][0]
+        if not isinstance(calls, list) or \
+                not all(isinstance(c, dict) and
+                        isinstance(c.get('method'), str) and
+                        len(c['method'].split('.')) == 2
+                        for c in calls):
+            abort(400)
+        batch = [[str(uuid.uuid1()), call] for call in calls]
+        # One message so the scheduler sees the whole batch at once
+        app.config['out_q'].put(['submit_batch', None, batch])
+        return {'result': [[job_id for (job_id, call) in batch]]}
     # async submi job
-    if method.startswith('_') and method.endswith('_submit'):
+    elif method.startswith('_') and method.endswith('_submit'):
         if token != app.config.get('token'):
             abort(401)
         job_id = str(uuid.uuid1())
         data['method'] = '%s.%s' % (module, method[1:-7])
         app.config['out_q'].put(['submit',  job_id, data])
         return {'result': job_id}
+    # batch check: has to come before the _check_job prefix match
+    elif method == '_check_jobs':
+        if 'params' not in data:
+            abort(404)
+        params = data['params']
+        if not isinstance(params, list) or len(params) == 0:
+            abort(400)
+        job_ids = params[0]
+        if not isinstance(job_ids, list) or \
+                not all(isinstance(j, str) for j in job_ids):
+            abort(400)
+        opts = dict()
+        if len(params) > 1 and params[1] is not None:
+            opts = params[1]
+        if not isinstance(opts, dict):
+            abort(400)
+        # as_completed returns once any of them is done, with just the
+        # finished ones
+        first = opts.get('as_completed', False)
+        await _wait_outputs(job_ids, timeout=_wait_param(opts.get('wait')),
+                            first=first)
+        results = []
+        for job_id in job_ids:
+            if job_id in outputs:
+                results.append(_finish(outputs.get(job_id), refs,
+                                       job_id=job_id))
+            elif not first:
+                results.append({'job_id': job_id, 'finished': False})
+        return _response({'result': [results]}, refs)
     # check job
     elif method.startswith('_check_job'):
         if 'params' not in data:
             abort(404)
         job_id = data['params'][0]
-        _check_finished()
-        resp = {'finished': False}
+        wait = 0
+        if len(data['params']) > 1:
+            # Long-poll: hold the call until the job finishes or we run
+            # out of time
+            wait = _wait_param(data['params'][1])
+        await _wait_output(job_id, timeout=wait)
         if job_id in outputs:
-            resp = outputs[job_id]
-            resp['finished'] = True
-        return {'result': [resp]}
+            return _response({'result': [_finish(outputs.get(job_id),
+                                                 refs)]}, refs)
+        return {'result': [{'finished': False}]}
     # Provenance
     elif method.startswith('get_provenance'):
         _check_finished()
@@ -55,31 +322,67 @@ async def _process_rpc(data, token):
             abort(401)
         job_id = str(uuid.uuid1())
         data['method'] = '%s.%s' % (module, method[1:-7])
+        waiters[job_id] = asyncio.get_event_loop().create_future()
         app.config['out_q'].put(['submit',  job_id, data])
         try:
-            while True:
-                _check_finished()
-                if job_id in outputs:
-                    resp = outputs[job_id]
-                    resp['finished'] = True
-                    return resp
-                await asyncio.sleep(1)
+            output = await _wait_output(job_id)
+            return _response(_finish(output, refs), refs)
         except Exception:
             return {'error': 'Timeout'}
 
 
+def _can_cancel(token):
+    if token is None:
+        return False
+    for allowed in [app.config.get('token'), app.config.get('cancel_token')]:
+        if allowed is not None and hmac.compare_digest(token, allowed):
+            return True
+    return False
+
+
+@app.route("/cancel", methods=['POST'])
+async def cancel(request):
+    """
+    Tell the job runner to shut the job down right away.
+    """
+    if not _can_cancel(request.headers.get('Authorization')):
+        abort(401)
+    app.config['out_q'].put(['cancel', None, None])
+    return json({'result': [{'canceled': True}]})
+
+
+@app.route("/stats", methods=['GET'])
+async def stats(request):
+    """
+    Report what the output store is holding.
+    """
+    return json({'outputs': outputs.stats()})
+
+
 @app.route("/", methods=['GET', 'POST'])
 async def root(request):
     data = request.json
     if request.method == 'POST' and data is not None and 'method' in data:
         token = request.headers.get('Authorization')
-        return json(await _process_rpc(data, token))
+        resp = await _process_rpc(data, token)
+        if isinstance(resp, dict):
+            return json(resp)
+        return resp
     return json({})
 
 
-def start_callback_server(ip, port, out_queue, in_queue, token):
+def _init_outputs(output_conf):
+    global outputs
+    if output_conf is not None:
+        outputs = OutputStore(**output_conf)
+
+
+def start_callback_server(ip, port, out_queue, in_queue, token,
+                          cancel_token=None, output_conf=None):
+    _init_outputs(output_conf)
     conf = {
         'token': token,
+        'cancel_token': cancel_token,
         'out_q': out_queue,
         'in_q': in_queue
     }
@@ -87,5 +390,26 @@ def start_callback_server(ip, port, out_queue, in_queue, token):
     app.run(host=ip, port=port, debug=False, access_log=False)
 
 
+async def serve_inprocess(ip, port, out_queue, token, cancel_token=None,
+                          output_conf=None):
+    """
+    Start the callback server on the running loop instead of its own
+    process.  Returns the asyncio server and the LoopQueue to send
+    outputs and provenance through.
+    """
+    _init_outputs(output_conf)
+    in_queue = LoopQueue(asyncio.get_event_loop())
+    conf = {
+        'token': token,
+        'cancel_token': cancel_token,
+        'out_q': out_queue,
+        'in_q': in_queue
+    }
+    app.config.update(conf)
+    server = await app.create_server(host=ip, port=port, access_log=False,
+                                     return_asyncio_server=True)
+    return (server, in_queue)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000)
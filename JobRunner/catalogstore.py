@@ -0,0 +1,105 @@
+import os
+import json
+import sqlite3
+from time import time as _time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    stored REAL NOT NULL,
+    refreshing REAL NOT NULL DEFAULT 0
+)
+"""
+
+
+class CatalogStore(object):
+    """
+    This class keeps catalog lookups in a SQLite file that every runner
+    on the node shares, so a module looked up by one job is there for
+    the next one.
+
+    Entries younger than ttl are fresh.  Up to stale seconds after that
+    they are still handed out but one runner should refresh them.  The
+    file holds secure config params so only the owner can read it.
+    """
+
+    def __init__(self, path, ttl=300, stale=3600, timeout=30):
+        """
+        Inputs: database file, seconds an entry is fresh, seconds it may
+        be used stale afterwards and how long to wait on a locked
+        database
+        """
+        self.path = path
+        self.ttl = ttl
+        self.stale = stale
+        self.timeout = timeout
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # Create it with the right mode before sqlite does
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(_SCHEMA)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # A connection per call since submits run on several threads
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.execute('PRAGMA busy_timeout={}'.format(int(self.timeout *
+                                                         1000)))
+        return conn
+
+    def get(self, key, now=None):
+        """
+        Returns (value, state) where state is fresh, stale or None if
+        there is nothing usable.
+        """
+        if now is None:
+            now = _time()
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT value, stored FROM entries '
+                               'WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return (None, None)
+        age = now - row[1]
+        if age < self.ttl:
+            return (json.loads(row[0]), 'fresh')
+        if age < self.ttl + self.stale:
+            return (json.loads(row[0]), 'stale')
+        return (None, None)
+
+    def put(self, key, value, now=None):
+        if now is None:
+            now = _time()
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO entries '
+                         '(key, value, stored, refreshing) '
+                         'VALUES (?, ?, ?, 0)',
+                         (key, json.dumps(value), now))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def claim_refresh(self, key, now=None):
+        """
+        Returns True if this caller should refresh a stale entry.  Only
+        one runner gets it until the refresh is done or ttl has passed.
+        """
+        if now is None:
+            now = _time()
+        conn = self._connect()
+        try:
+            cur = conn.execute('UPDATE entries SET refreshing = ? '
+                               'WHERE key = ? AND refreshing < ?',
+                               (now, key, now - self.ttl))
+            conn.commit()
+            return cur.rowcount == 1
+        finally:
+            conn.close()
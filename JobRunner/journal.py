@@ -0,0 +1,118 @@
+import os
+import json
+from threading import Lock
+
+
+class LogJournal(object):
+    """
+    This class provides an append-only, on-disk journal of job log lines.
+
+    Every line is written as a JSON record before it is shipped to NJS.
+    A cursor file records the offset up to which NJS has acknowledged
+    the lines so anything after it can be replayed after an outage or
+    a runner restart.
+    """
+
+    def __init__(self, path):
+        """
+        Inputs: path to the journal file
+        """
+        self.path = path
+        self.cursor_file = path + '.cursor'
+        self._lock = Lock()
+        self._truncate_partial()
+        self._fd = open(self.path, 'ab')
+        self.size = self._fd.tell()
+        self.cursor = min(self._read_cursor(), self.size)
+
+    def _truncate_partial(self):
+        # A crash in the middle of a write can leave a partial record
+        # at the end.  Drop it so new records start on a clean line.
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            pos = end
+            while pos > 0:
+                step = min(4096, pos)
+                f.seek(pos - step)
+                chunk = f.read(step)
+                idx = chunk.rfind(b'\n')
+                if idx >= 0:
+                    pos = pos - step + idx + 1
+                    break
+                pos -= step
+            if pos != end:
+                f.truncate(pos)
+
+    def _read_cursor(self):
+        try:
+            with open(self.cursor_file) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return 0
+
+    def append(self, lines):
+        """
+        Append lines to the journal and return the new end offset.
+        """
+        data = b''.join([json.dumps(line).encode('utf-8') + b'\n'
+                         for line in lines])
+        with self._lock:
+            self._fd.write(data)
+            self._fd.flush()
+            self.size += len(data)
+            return self.size
+
+    def sync(self):
+        with self._lock:
+            os.fsync(self._fd.fileno())
+
+    def ack(self, offset):
+        """
+        Record that everything up to offset has been accepted by NJS.
+        """
+        if offset <= self.cursor:
+            return
+        tmp = self.cursor_file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp, self.cursor_file)
+        self.cursor = offset
+
+    def pending(self):
+        return self.cursor < self.size
+
+    def read(self, offset, max_lines):
+        """
+        Read up to max_lines complete records starting at offset.
+        Returns the lines and the offset just past the last one read.
+        """
+        limit = self.size
+        lines = []
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for raw in f:
+                if offset + len(raw) > limit or not raw.endswith(b'\n'):
+                    break
+                offset += len(raw)
+                lines.append(json.loads(raw.decode('utf-8')))
+                if len(lines) >= max_lines:
+                    break
+        return lines, offset
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
+
+    def remove(self):
+        """
+        Close and delete the journal once everything has been sent.
+        """
+        self.close()
+        for path in [self.path, self.cursor_file]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
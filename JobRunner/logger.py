@@ -1,13 +1,28 @@
 import sys
 import os
+import atexit
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
+from time import time as _time
 from clients.NarrativeJobServiceClient import NarrativeJobService
+from .journal import LogJournal
+from .logpolicy import LogPolicy
 
 
-# TODO: Add a buffer  we may need some flush thread too.
-
 class Logger(object):
+    """
+    This class buffers job log lines and ships them to NJS in batches.
+
+    Lines are placed on a bounded in-memory queue and a flush thread
+    coalesces them into add_job_logs calls by batch size and age.
+    When a workdir is configured every line is first appended to an
+    on-disk journal.  If NJS is slow or down the flush thread backs off
+    and replays the unacknowledged part of the journal once it is back.
+    The journal is deleted when the logger closes with everything sent.
+    Container output passes through a LogPolicy before it is queued.
+    """
 
-    def __init__(self, njs_url, job_id, njs=None):
+    def __init__(self, njs_url, job_id, njs=None, config=None):
         self.njs_url = njs_url
         if njs is None:
             self.njs = NarrativeJobService(self.njs_url)
@@ -15,23 +30,208 @@ class Logger(object):
             self.njs = njs
         self.job_id = job_id
         self.debug = os.environ.get('DEBUG_RUNNER', None)
+        if config is None:
+            config = {}
+        self.batch_size = config.get('log_batch_size', 1000)
+        self.flush_interval = config.get('log_flush_interval', 1)
+        self.retry_max = config.get('log_retry_max', 60)
+        self.queue = Queue(maxsize=config.get('log_queue_size', 100000))
+        self.journal = None
+        workdir = config.get('workdir')
+        if config.get('log_journal', True) and workdir is not None and \
+           os.path.isdir(workdir):
+            path = os.path.join(workdir, '{}.logs'.format(job_id))
+            self.journal = LogJournal(path)
+        self.policy = LogPolicy(config, job_id)
+        # Replay anything a previous runner left unsent
+        self.replay = self.journal is not None and self.journal.pending()
+        self.backoff = 0
+        self.retry_at = 0
+        self.closed = False
+        self._put_lock = Lock()
+        self._thread = Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        # Make sure buffered lines go out even if the runner exits early
+        atexit.register(self.close)
         print("Logger initialized for %s" % (job_id))
 
-    def log_lines(self, lines):
+    def _send(self, batch, offset=None):
+        if len(batch) == 0:
+            return True
+        try:
+            if self.journal is not None:
+                self.journal.sync()
+            self.njs.add_job_logs(self.job_id, batch)
+        except Exception as e:
+            sys.stderr.write("Failed to send {} log lines: {}\n".format(
+                len(batch), e))
+            if self.journal is not None:
+                # The lines are safe in the journal.  Replay them later.
+                self.replay = True
+                self.backoff = min(max(self.backoff * 2, 1), self.retry_max)
+                self.retry_at = _time() + self.backoff
+            return False
+        if offset is not None:
+            self.journal.ack(offset)
+        return True
+
+    def _replay(self):
+        """
+        Resend the unacknowledged part of the journal.
+        Returns True once it has caught up.
+        """
+        while self.journal.pending():
+            (lines, offset) = self.journal.read(self.journal.cursor,
+                                                self.batch_size)
+            if len(lines) == 0:
+                break
+            if not self._send(lines, offset):
+                return False
+        self.replay = False
+        self.backoff = 0
+        return True
+
+    def _flush_loop(self):
+        batch = []
+        offset = None
+        deadline = None
+        while True:
+            if self.replay:
+                batch = []
+                deadline = None
+                if _time() >= self.retry_at:
+                    self._replay()
+            timeout = None
+            if self.replay:
+                timeout = max(self.retry_at - _time(), 0)
+            elif deadline is not None:
+                timeout = max(deadline - _time(), 0)
+            try:
+                (cmd, payload) = self.queue.get(timeout=timeout)
+            except Empty:
+                (cmd, payload) = (None, None)
+            if cmd in ['flush', 'close']:
+                # Give NJS one more chance before giving up on the flush.
+                # Anything still unsent stays in the journal.
+                if self.replay:
+                    self._replay()
+                else:
+                    self._send(batch, offset)
+                batch = []
+                offset = None
+                deadline = None
+                if cmd == 'close':
+                    with self._put_lock:
+                        self._drop_journal()
+                    payload.set()
+                    return
+                payload.set()
+                continue
+            if cmd == 'lines':
+                (lines, end) = payload
+                if self.replay or \
+                   (end is not None and end <= self.journal.cursor):
+                    # Already journaled and will be (or was) replayed
+                    continue
+                if deadline is None:
+                    deadline = _time() + self.flush_interval
+                batch.extend(lines)
+                offset = end
+            if len(batch) >= self.batch_size or \
+               (deadline is not None and _time() >= deadline):
+                self._send(batch, offset)
+                batch = []
+                offset = None
+                deadline = None
+
+    def _drop_journal(self):
+        # Call with _put_lock held
+        if self.journal is not None and not self.journal.pending():
+            self.journal.remove()
+            self.journal = None
+
+    def _put_closed(self, lines):
+        # Call with _put_lock held.  No flush thread anymore, so send
+        # directly
+        if self.journal is None:
+            self._send(lines)
+            return
+        caught_up = not self.journal.pending()
+        end = self.journal.append(lines)
+        if self._thread.is_alive():
+            # close() timed out and the flush thread still owns it
+            sent = False
+        elif caught_up:
+            sent = self._send(lines, end)
+        else:
+            # Send the earlier unsent lines first to keep the order
+            sent = self._replay()
+        if not sent:
+            f = "Warning: {} log lines left in {} to send on restart\n"
+            sys.stderr.write(f.format(len(lines), self.journal.path))
+            return
+        self._drop_journal()
+
+    def _put(self, lines):
+        # Journal and queue together so offsets reach the flush thread
+        # in order.  close() could have run while waiting on the lock.
+        with self._put_lock:
+            if self.closed:
+                self._put_closed(lines)
+                return
+            end = None
+            if self.journal is not None:
+                end = self.journal.append(lines)
+            self.queue.put(('lines', (lines, end)))
+
+    def flush(self, timeout=None):
+        """
+        Block until everything logged so far has been sent.
+        """
+        if self.closed:
+            return
+        ev = Event()
+        self.queue.put(('flush', ev))
+        ev.wait(timeout)
+
+    def close(self, timeout=None):
+        """
+        Flush any buffered lines and stop the flush thread.
+        """
+        ev = Event()
+        # Lines queued after the close command would never be sent
+        with self._put_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(('close', ev))
+        ev.wait(timeout)
+
+    def log_lines(self, lines, source=None):
+        if source is not None:
+            lines = self.policy.filter(lines, source)
+        if len(lines) == 0:
+            return
         if self.debug:  # pragma: no cover
             for line in lines:
                 if line['is_error']:
-                    sys.stderr.write(line+'\n')
+                    sys.stderr.write(line['line']+'\n')
                 else:
                     print(line['line'])
-        self.njs.add_job_logs(self.job_id, lines)
+        self._put(lines)
+
+    def end_stream(self, source):
+        """
+        Called when a container exits to log any pending policy markers.
+        """
+        self.log_lines(self.policy.finish(source))
 
     def log(self, line):
         if self.debug:  # pragma: no cover
             print(line, flush=True)
-        self.njs.add_job_logs(self.job_id, [{'line': line, 'is_error': 0}])
+        self._put([{'line': line, 'is_error': 0}])
 
     def error(self, line):
         if self.debug:  # pragma: no cover
             print(line, flush=True)
-        self.njs.add_job_logs(self.job_id, [{'line': line, 'is_error': 1}])
+        self._put([{'line': line, 'is_error': 1}])
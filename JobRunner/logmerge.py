@@ -0,0 +1,131 @@
+import heapq
+from calendar import timegm
+from time import strptime
+
+_NS = 1000000000
+
+
+class TimestampParser(object):
+    """
+    This class turns docker RFC3339Nano timestamps into integer
+    nanoseconds since the epoch.
+
+    The seconds part only changes once a second so the last one is
+    cached and only the fraction is parsed for most lines.
+    """
+
+    def __init__(self):
+        self.prefix = '-'
+        self.seconds = 0
+
+    def parse(self, ts):
+        prefix = ts[:19]
+        if prefix != self.prefix:
+            secs = timegm(strptime(prefix, '%Y-%m-%dT%H:%M:%S'))
+            self.seconds = secs * _NS
+            self.prefix = prefix
+        # Docker trims trailing zeros from the fraction
+        frac = 0
+        if len(ts) > 20 and ts[19] == '.':
+            digits = ts[20:].rstrip('Z')[:9]
+            frac = int(digits.ljust(9, '0'))
+        return self.seconds + frac
+
+
+class LogMerger(object):
+    """
+    This class turns timestamped stdout and stderr output into log
+    lines.
+
+    Whole buffers from both streams are parsed once into (timestamp,
+    seq, ...) tuples and combined with a heap based k-way merge.  Ties
+    keep their arrival order with stdout first.
+
+    Streamed chunks come from one stream at a time and docker sends each
+    stream in order, so push() only strips the timestamps.  Partial
+    lines are held until the rest of the line arrives.
+    """
+
+    def __init__(self):
+        self.parser = TimestampParser()
+        self.partial = [b'', b'']
+        self.last = [0, 0]
+        self.seq = 0
+
+    def _parse(self, data, is_error):
+        parser = self.parser
+        prefix = parser.prefix
+        seconds = parser.seconds
+        out = []
+        append = out.append
+        seq = self.seq
+        last = self.last[is_error]
+        ordered = True
+        for raw in data.decode('utf-8', 'replace').split('\n'):
+            if not raw:
+                continue
+            (ts, _, txt) = raw.partition(' ')
+            try:
+                if len(ts) == 30 and ts.startswith(prefix):
+                    # Fast path: same second, full nanosecond fraction
+                    t = seconds + int(ts[20:29])
+                else:
+                    t = parser.parse(ts)
+                    prefix = parser.prefix
+                    seconds = parser.seconds
+            except ValueError:
+                # Not timestamped.  Keep it where it showed up.
+                (t, txt) = (last, raw)
+            if t < last:
+                ordered = False
+            last = t
+            append((t, seq, is_error, txt))
+            seq += 1
+        self.seq = seq
+        self.last[is_error] = last
+        if not ordered:
+            out.sort()
+        return out
+
+    def merge(self, sout, serr):
+        """
+        Merge complete stdout and stderr buffers.
+        """
+        outs = self._parse(sout, 0)
+        errs = self._parse(serr, 1)
+        return [{'line': txt, 'is_error': is_error}
+                for (t, seq, is_error, txt) in heapq.merge(outs, errs)]
+
+    def push(self, is_error, data):
+        """
+        Add a chunk of output from one stream and return the complete
+        lines it finishes, in time order.
+        """
+        data = self.partial[is_error] + data
+        end = data.rfind(b'\n') + 1
+        self.partial[is_error] = data[end:]
+        if end == 0:
+            return []
+        return self._lines(data[:end], is_error)
+
+    def _lines(self, data, is_error):
+        out = []
+        append = out.append
+        for raw in data.decode('utf-8', 'replace').split('\n'):
+            if not raw:
+                continue
+            (ts, _, txt) = raw.partition(' ')
+            if len(ts) < 20 or ts[10] != 'T' or ts[-1] != 'Z':
+                # Not timestamped.  Keep the whole line.
+                txt = raw
+            append({'line': txt, 'is_error': is_error})
+        return out
+
+    def flush(self):
+        """
+        Return whatever is left over without a trailing newline, stdout
+        first.
+        """
+        (sout, serr) = self.partial
+        self.partial = [b'', b'']
+        return self._lines(sout, 0) + self._lines(serr, 1)
@@ -0,0 +1,182 @@
+import os
+from threading import Lock
+from time import time as _time
+
+
+class LogPolicy(object):
+    """
+    This class applies the job log policies to container output.
+
+    It collapses repeated lines, enforces per-job and per-container
+    byte/line budgets and a per-container token-bucket rate limit.
+    Lines held back by a budget or the rate limit are kept in a local
+    overflow file, up to log_overflow_max_bytes, and the job log gets a
+    short marker instead of them.
+    """
+
+    def __init__(self, config, job_id):
+        """
+        Inputs: config dictionary and Job ID
+        """
+        self.max_bytes = config.get('log_max_bytes')
+        self.max_lines = config.get('log_max_lines')
+        self.container_max_bytes = config.get('log_container_max_bytes')
+        self.container_max_lines = config.get('log_container_max_lines')
+        self.rate = config.get('log_rate')
+        if self.rate is not None and self.rate <= 0:
+            raise ValueError("log_rate must be positive")
+        # The bucket has to hold at least one whole line
+        self.burst = max(1, config.get('log_burst', self.rate or 1))
+        self.collapse = config.get('log_collapse_repeats', True)
+        self.overflow = None
+        workdir = config.get('workdir')
+        if workdir is not None and os.path.isdir(workdir):
+            self.overflow = os.path.join(workdir,
+                                         '{}.overflow.log'.format(job_id))
+        self.overflow_max = config.get('log_overflow_max_bytes',
+                                       100 * 1024 * 1024)
+        self.overflow_bytes = 0
+        self.truncated = False
+        self.bytes = 0
+        self.lines = 0
+        self.streams = dict()
+        self._lock = Lock()
+        self._fd = None
+
+    def _where(self):
+        if self.overflow is None or self.truncated:
+            return 'discarded'
+        return 'kept in {}'.format(self.overflow)
+
+    def _record(self, source, line, out):
+        if self.overflow is None or self.truncated:
+            return
+        data = '{} {} {}\n'.format(source, line.get('is_error', 0),
+                                   line['line'].rstrip('\n'))
+        size = len(data.encode('utf-8'))
+        if self.overflow_max is not None and \
+           self.overflow_bytes + size > self.overflow_max:
+            self.truncated = True
+            f = '{} truncated at {} bytes. Further held back output discarded'
+            out.append(self._marker(f.format(self.overflow,
+                                             self.overflow_bytes)))
+            return
+        if self._fd is None:
+            self._fd = open(self.overflow, 'w')
+        self._fd.write(data)
+        self.overflow_bytes += size
+
+    def _marker(self, text):
+        return {'line': text, 'is_error': 1}
+
+    def _state(self, source):
+        if source not in self.streams:
+            self.streams[source] = {
+                'bytes': 0,
+                'lines': 0,
+                'last': None,
+                'repeats': 0,
+                'over_budget': False,
+                'tokens': self.burst,
+                'refill': _time(),
+                'limited': 0
+            }
+        return self.streams[source]
+
+    def _over_budget(self, st):
+        if self.max_bytes is not None and self.bytes >= self.max_bytes:
+            return True
+        if self.max_lines is not None and self.lines >= self.max_lines:
+            return True
+        if self.container_max_bytes is not None and \
+           st['bytes'] >= self.container_max_bytes:
+            return True
+        if self.container_max_lines is not None and \
+           st['lines'] >= self.container_max_lines:
+            return True
+        return False
+
+    def _take_token(self, st):
+        if self.rate is None:
+            return True
+        now = _time()
+        st['tokens'] = min(self.burst,
+                           st['tokens'] + (now - st['refill']) * self.rate)
+        st['refill'] = now
+        if st['tokens'] < 1:
+            return False
+        st['tokens'] -= 1
+        return True
+
+    def _end_repeats(self, st, out):
+        if st['repeats'] > 0 and not st['over_budget']:
+            f = 'Last line repeated {} times'
+            out.append({'line': f.format(st['repeats']),
+                        'is_error': st['last'][1]})
+        st['repeats'] = 0
+
+    def _end_limited(self, source, st, out):
+        if st['limited'] > 0:
+            f = '{} lines from {} were rate limited and {}'
+            out.append(self._marker(f.format(st['limited'], source,
+                                             self._where())))
+            st['limited'] = 0
+
+    def filter(self, lines, source):
+        """
+        Apply the policies to lines from source.
+        Returns the lines (and markers) that should go to the job log.
+        """
+        out = []
+        with self._lock:
+            st = self._state(source)
+            for line in lines:
+                key = (line['line'], line.get('is_error', 0))
+                if self.collapse and key == st['last']:
+                    st['repeats'] += 1
+                    if st['over_budget']:
+                        # Never reported, so keep it with the rest
+                        self._record(source, line, out)
+                    continue
+                self._end_repeats(st, out)
+                st['last'] = key
+                if st['over_budget']:
+                    self._record(source, line, out)
+                    continue
+                if self._over_budget(st):
+                    st['over_budget'] = True
+                    f = 'Log budget exceeded for {}. Further output {}'
+                    out.append(self._marker(f.format(source, self._where())))
+                    self._record(source, line, out)
+                    continue
+                if not self._take_token(st):
+                    if st['limited'] == 0:
+                        f = 'Log rate limit reached for {}. Output {}'
+                        out.append(self._marker(f.format(source,
+                                                         self._where())))
+                    st['limited'] += 1
+                    self._record(source, line, out)
+                    continue
+                self._end_limited(source, st, out)
+                size = len(line['line'])
+                st['bytes'] += size
+                st['lines'] += 1
+                self.bytes += size
+                self.lines += 1
+                out.append(line)
+            if self._fd is not None:
+                self._fd.flush()
+        return out
+
+    def finish(self, source):
+        """
+        Close out a source and return any pending summary markers.
+        """
+        out = []
+        with self._lock:
+            if source not in self.streams:
+                return out
+            st = self.streams.pop(source)
+            self._end_repeats(st, out)
+            self._end_limited(source, st, out)
+        return out
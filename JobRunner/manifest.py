@@ -0,0 +1,27 @@
+def parse_entry(entry):
+    """
+    Split a manifest entry like module[.method][:version] into
+    (module, method, version).  Missing parts are None.
+    """
+    (name, _, version) = entry.strip().partition(':')
+    (module, _, method) = name.partition('.')
+    return (module, method or None, version or None)
+
+
+def parse_entries(text):
+    """
+    Parse manifest entries separated by commas or new lines.  Blank
+    lines and # comments are skipped.
+    """
+    entries = []
+    for line in text.split('\n'):
+        line = line.split('#')[0]
+        for item in line.split(','):
+            if item.strip() != '':
+                entries.append(parse_entry(item))
+    return entries
+
+
+def load_manifest(path):
+    with open(path) as f:
+        return parse_entries(f.read())
@@ -0,0 +1,66 @@
+import json
+import hashlib
+from threading import Lock
+
+
+class SubjobMemo(object):
+    """
+    This class remembers the results of subjob calls so identical calls
+    in the same job don't start another container.
+
+    Calls are keyed by a hash of the method, the resolved git commit and
+    the params.  Only methods on the allow-list are memoized since not
+    every method is pure.  While the first call is still running the
+    duplicates wait on it.
+    """
+
+    def __init__(self, allow=None):
+        """
+        Inputs: list of modules or module.methods that may be memoized
+        """
+        self.allow = set(allow or [])
+        self.results = dict()
+        self.inflight = dict()
+        self.leaders = dict()
+        self.lock = Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'collapsed': 0}
+
+    def allowed(self, method):
+        return method in self.allow or method.split('.')[0] in self.allow
+
+    def key(self, method, commit, params):
+        call = {'method': method, 'commit': commit, 'params': params}
+        data = json.dumps(call, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def claim(self, key, job_id):
+        """
+        Returns ('hit', result) if the call already finished, ('wait',
+        None) if the same call is running and ('run', None) if this job
+        should run it.
+        """
+        with self.lock:
+            if key in self.results:
+                self.stats['hits'] += 1
+                return ('hit', self.results[key])
+            if key in self.inflight:
+                self.stats['collapsed'] += 1
+                self.inflight[key].append(job_id)
+                return ('wait', None)
+            self.stats['misses'] += 1
+            self.inflight[key] = []
+            self.leaders[job_id] = key
+            return ('run', None)
+
+    def complete(self, job_id, result, cache=True):
+        """
+        Record the result of a job that ran a memoized call.  Returns the
+        job ids that were waiting on it.
+        """
+        with self.lock:
+            key = self.leaders.pop(job_id, None)
+            if key is None:
+                return []
+            if cache:
+                self.results[key] = result
+            return self.inflight.pop(key, [])
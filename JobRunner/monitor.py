@@ -0,0 +1,47 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+
+class ContainerMonitor(object):
+    """
+    This class runs a single asyncio loop that watches every container
+    the runner starts.
+
+    Log streams and exit notifications are handled as coroutines on the
+    loop.  Blocking calls (docker inspect/remove, process waits) are
+    handed to a small bounded thread pool.
+    """
+
+    def __init__(self, max_workers=4):
+        """
+        Inputs: size of the worker pool for blocking calls
+        """
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.loop.set_default_executor(self.executor)
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the monitor loop from any thread.
+        Returns a concurrent.futures.Future.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_blocking(self, fn, *args):
+        """
+        Run a blocking call in the worker pool.  Await this from a
+        coroutine on the monitor loop.
+        """
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.executor.shutdown(wait=False)
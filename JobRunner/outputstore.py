@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from time import time as _time
+
+
+class OutputRef(object):
+    """
+    This class points at a finished job's output file.  The file is
+    streamed to whoever asks for it rather than held in memory.
+    """
+
+    def __init__(self, ref, owned=False):
+        """
+        Inputs: dict with path, size and digest, and whether the store
+        wrote the file (and so should delete it)
+        """
+        self.path = ref['path']
+        self.size = ref['size']
+        self.digest = ref['digest']
+        self.owned = owned
+
+
+class OutputStore(object):
+    """
+    This class holds finished job outputs for the callback server.
+
+    Outputs kept in memory are limited to a byte budget.  Anything
+    bigger than spill_size, or that would go over the budget, is written
+    to spill_dir and kept as an OutputRef.  Once an output has been
+    fetched it is dropped after a grace period.  Jobs that were dropped
+    are remembered so a late check gets an error instead of waiting
+    forever.
+    """
+
+    def __init__(self, budget=256*1024*1024, grace=300, spill_dir=None,
+                 spill_size=1024*1024):
+        """
+        Inputs: memory budget in bytes, seconds to keep fetched outputs,
+        where to spill (defaults to keeping everything in memory) and
+        the size above which an output is always spilled
+        """
+        self.budget = budget
+        self.grace = grace
+        self.spill_dir = spill_dir
+        self.spill_size = spill_size
+        self.entries = dict()
+        self.sizes = dict()
+        self.fetched = OrderedDict()
+        self.expired = set()
+        self.bytes = 0
+        self.counts = {'stored': 0, 'spilled': 0, 'fetched': 0,
+                       'evicted': 0}
+
+    def __contains__(self, job_id):
+        return job_id in self.entries or job_id in self.expired
+
+    def _spill(self, job_id, data):
+        path = os.path.join(self.spill_dir, '{}.json'.format(job_id))
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.counts['spilled'] += 1
+        ref = {'path': path, 'size': len(data),
+               'digest': hashlib.sha256(data).hexdigest()}
+        return OutputRef(ref, owned=True)
+
+    def put(self, job_id, output):
+        """
+        Store a job's output (a dict or an OutputRef).
+        """
+        self.evict()
+        size = 0
+        if not isinstance(output, OutputRef):
+            data = json.dumps(output).encode('utf-8')
+            size = len(data)
+            if self.spill_dir is not None and \
+                    (size > self.spill_size or
+                     self.bytes + size > self.budget):
+                output = self._spill(job_id, data)
+                size = 0
+        self._drop(job_id)
+        self.entries[job_id] = output
+        self.sizes[job_id] = size
+        self.bytes += size
+        self.counts['stored'] += 1
+
+    def get(self, job_id):
+        """
+        Return a job's output and start its grace period.
+        """
+        self.evict()
+        if job_id in self.expired:
+            return {'error': {
+                'code': -32601,
+                'name': 'Output expired',
+                'message': 'Output for {} was already fetched'.format(job_id)
+            }}
+        if job_id not in self.fetched:
+            self.counts['fetched'] += 1
+            self.fetched[job_id] = _time()
+        return self.entries[job_id]
+
+    def _drop(self, job_id):
+        output = self.entries.pop(job_id, None)
+        self.bytes -= self.sizes.pop(job_id, 0)
+        self.fetched.pop(job_id, None)
+        if isinstance(output, OutputRef) and output.owned:
+            try:
+                os.remove(output.path)
+            except OSError:
+                pass
+
+    def evict(self, now=None):
+        """
+        Drop outputs fetched more than grace seconds ago.
+        """
+        if now is None:
+            now = _time()
+        while len(self.fetched) > 0:
+            (job_id, fetched) = next(iter(self.fetched.items()))
+            if now - fetched < self.grace:
+                break
+            self._drop(job_id)
+            self.expired.add(job_id)
+            self.counts['evicted'] += 1
+
+    def stats(self):
+        s = dict(self.counts)
+        s['entries'] = len(self.entries)
+        s['bytes'] = self.bytes
+        s['budget'] = self.budget
+        s['spilled_entries'] = len([o for o in self.entries.values()
+                                    if isinstance(o, OutputRef)])
+        return s
@@ -0,0 +1,135 @@
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from time import sleep, time
+
+_STATE = 'images.json'
+# Runners under other uids share the directory
+_MODE = 0o666
+_DIR_MODE = 0o777
+
+
+class PullCoordinator(object):
+    """
+    This class coordinates image pulls between every JobRunner process on
+    a node.
+
+    Each image gets a lock file in a shared directory.  The first process
+    to take the lock pulls the image while the others wait on it and then
+    find the image already there.  A fixed number of slot lock files caps
+    how many pulls run on the node at once.  Pulled images are recorded
+    in a small shared JSON state file so later pulls of an image that is
+    still there skip the image lock.  Everything is created group and
+    world writable since runners may run as different users.
+    """
+
+    def __init__(self, lock_dir='/tmp/jr_image_locks', max_pulls=2,
+                 poll=0.5):
+        """
+        Inputs: shared lock directory, node-wide cap on concurrent pulls
+        and how often to retry for a free slot
+        """
+        self.lock_dir = lock_dir
+        self.max_pulls = max(1, max_pulls)
+        self.poll = poll
+        if not os.path.exists(lock_dir):
+            os.makedirs(lock_dir, exist_ok=True)
+            self._chmod(lock_dir, _DIR_MODE)
+
+    def _path(self, name):
+        return os.path.join(self.lock_dir, name)
+
+    def _chmod(self, path, mode):
+        # Only the owner can and the umask may have narrowed it
+        try:
+            os.chmod(path, mode)
+        except PermissionError:
+            pass
+
+    def _open(self, name):
+        path = self._path(name)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, _MODE)
+        if os.fstat(fd).st_mode & _MODE != _MODE:
+            self._chmod(path, _MODE)
+        return os.fdopen(fd, 'a+')
+
+    @contextmanager
+    def _lock(self, name, flags=fcntl.LOCK_EX):
+        with self._open(name) as f:
+            fcntl.flock(f, flags)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _slot(self):
+        """
+        Wait for one of the node-wide pull slots.
+        """
+        while True:
+            for i in range(self.max_pulls):
+                f = self._open('slot.{}'.format(i))
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    f.close()
+                    continue
+                try:
+                    yield i
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    f.close()
+                return
+            sleep(self.poll)
+
+    def state(self):
+        """
+        Return the shared record of pulled images.
+        """
+        with self._lock(_STATE + '.lock', fcntl.LOCK_SH):
+            try:
+                with open(self._path(_STATE)) as f:
+                    return json.load(f)
+            except (IOError, ValueError):
+                return dict()
+
+    def _record(self, image, id):
+        with self._lock(_STATE + '.lock'):
+            try:
+                with open(self._path(_STATE)) as f:
+                    state = json.load(f)
+            except (IOError, ValueError):
+                state = dict()
+            state[image] = {'id': id, 'pulled': time(), 'pid': os.getpid()}
+            tmp = self._path('{}.{}'.format(_STATE, os.getpid()))
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            self._chmod(tmp, _MODE)
+            os.replace(tmp, self._path(_STATE))
+
+    def pull(self, image, lookup, pull):
+        """
+        Return the id for image, pulling it at most once across the node.
+
+        Inputs: image name, a function returning the local id or None and
+        a function that pulls the image and returns its id
+        """
+        # Already pulled and still there
+        pulled = self.state().get(image)
+        if pulled is not None:
+            id = lookup()
+            if id is not None and id == pulled['id']:
+                return id
+        key = hashlib.sha1(image.encode('utf-8')).hexdigest()
+        with self._lock('image.{}'.format(key)):
+            # Someone else may have pulled it while we waited
+            id = lookup()
+            if id is not None:
+                return id
+            with self._slot():
+                id = pull()
+            self._record(image, id)
+            return id
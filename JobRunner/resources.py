@@ -0,0 +1,226 @@
+import os
+from threading import Lock
+
+_CGROUP_ROOT = '/sys/fs/cgroup'
+_UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def parse_memory(value):
+    """
+    Turn a memory request like 2000M or 4G into bytes.  Plain numbers
+    are megabytes the way HTCondor reads request_memory.
+    """
+    value = str(value).strip().upper().rstrip('B')
+    if len(value) > 0 and value[-1] in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1]])
+    return int(float(value) * _UNITS['M'])
+
+
+def parse_hints(client_groups):
+    """
+    Pull request_cpus and request_memory out of catalog client group
+    strings like "njs,request_cpus=4,request_memory=2000M".
+    """
+    hints = dict()
+    for group in client_groups or []:
+        for item in group.split(','):
+            (key, _, value) = item.strip().partition('=')
+            try:
+                if key == 'request_cpus':
+                    hints['cpus'] = float(value)
+                elif key == 'request_memory':
+                    hints['memory'] = parse_memory(value)
+            except ValueError:
+                continue
+    return hints
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _own_cgroups():
+    """
+    Return a controller -> path map for this process.
+    """
+    paths = dict()
+    for line in (_read('/proc/self/cgroup') or '').split('\n'):
+        items = line.split(':')
+        if len(items) != 3:
+            continue
+        for controller in items[1].split(','):
+            paths[controller] = items[2]
+    return paths
+
+
+class NodeResources(object):
+    """
+    This class reads the CPU and memory this job is allowed to use and
+    how much memory is free right now.
+
+    cgroup v2 and v1 limits are tried first using the cgroup the job
+    runs in.  Without a limit the whole node counts.
+    """
+
+    def __init__(self, cgroup=None, root=_CGROUP_ROOT):
+        """
+        Inputs: cgroup path found by JobRunner._get_cgroup (or None) and
+        the cgroup filesystem root
+        """
+        self.root = root
+        paths = _own_cgroups()
+        if cgroup is not None and cgroup.strip() not in ['', 'Unknown']:
+            cgroup = cgroup.strip()
+            paths = {'': cgroup, 'memory': cgroup, 'cpu': cgroup}
+        self.paths = paths
+        self.cpus = self._cpu_limit()
+        self.memory = self._memory_limit()
+
+    def _v2(self, name):
+        path = self.paths.get('', '/').lstrip('/')
+        return _read(os.path.join(self.root, path, name))
+
+    def _v1(self, controller, name):
+        path = self.paths.get(controller, '/').lstrip('/')
+        return _read(os.path.join(self.root, controller, path, name))
+
+    def _cpu_limit(self):
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = float(len(os.sched_getaffinity(0)))
+        else:
+            cpus = float(os.cpu_count() or 1)
+        quota = None
+        v2 = self._v2('cpu.max')
+        if v2 is not None:
+            (q, _, period) = v2.partition(' ')
+            if q != 'max':
+                quota = float(q) / float(period or 100000)
+        else:
+            q = self._v1('cpu', 'cpu.cfs_quota_us')
+            period = self._v1('cpu', 'cpu.cfs_period_us')
+            if q is not None and period is not None and int(q) > 0:
+                quota = float(q) / float(period)
+        if quota is not None:
+            cpus = min(cpus, quota)
+        return cpus
+
+    def _meminfo(self, field):
+        for line in (_read('/proc/meminfo') or '').split('\n'):
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+        return None
+
+    def _memory_limit(self):
+        total = self._meminfo('MemTotal')
+        limit = self._v2('memory.max')
+        if limit is None:
+            limit = self._v1('memory', 'memory.limit_in_bytes')
+        if limit is not None and limit != 'max':
+            limit = int(limit)
+            # v1 reports a huge number when there is no limit
+            if total is None or limit < total:
+                return limit
+        return total
+
+    def free_memory(self):
+        """
+        Return the memory that is free for new work right now.
+        """
+        free = self._meminfo('MemAvailable')
+        used = self._v2('memory.current')
+        if used is None:
+            used = self._v1('memory', 'memory.usage_in_bytes')
+        if used is not None and self.memory is not None:
+            headroom = self.memory - int(used)
+            if free is None or headroom < free:
+                free = headroom
+        return free
+
+
+class ResourceTracker(object):
+    """
+    This class keeps track of the CPU and memory reserved by running
+    subjobs and says whether another one fits.
+    """
+
+    def __init__(self, node, default=None):
+        """
+        Inputs: NodeResources and the request used for modules without
+        hints
+        """
+        self.node = node
+        self.default = default or {'cpus': 0, 'memory': 0}
+        self.reserved = dict()
+
+    def request(self, hints):
+        req = dict(self.default)
+        req.update(hints or {})
+        return req
+
+    def _used(self, key):
+        return sum(r.get(key, 0) for r in self.reserved.values())
+
+    def fits(self, req):
+        if len(self.reserved) == 0:
+            # Something too big for the node still gets to run alone
+            return True
+        if req.get('cpus', 0) > 0 and self.node.cpus is not None:
+            if self._used('cpus') + req['cpus'] > self.node.cpus:
+                return False
+        if req.get('memory', 0) > 0 and self.node.memory is not None:
+            if self._used('memory') + req['memory'] > self.node.memory:
+                return False
+            free = self.node.free_memory()
+            if free is not None and req['memory'] > free:
+                return False
+        return True
+
+    def acquire(self, job_id, req):
+        self.reserved[job_id] = req
+
+    def release(self, job_id):
+        self.reserved.pop(job_id, None)
+
+
+class CpusetAllocator(object):
+    """
+    This class hands out disjoint sets of CPUs to containers that run at
+    the same time so they don't share cores and caches.
+    """
+
+    def __init__(self, cpus=None):
+        """
+        Inputs: CPUs to hand out (defaults to the ones this process may
+        run on)
+        """
+        if cpus is None:
+            if hasattr(os, 'sched_getaffinity'):
+                cpus = os.sched_getaffinity(0)
+            else:
+                cpus = range(os.cpu_count() or 1)
+        self.free = sorted(cpus)
+        self.assigned = dict()
+        self.lock = Lock()
+
+    def allocate(self, job_id, count):
+        """
+        Return a list of count CPUs for job_id or None if not enough are
+        free.
+        """
+        with self.lock:
+            if count < 1 or count > len(self.free):
+                return None
+            cpus = self.free[:count]
+            self.free = self.free[count:]
+            self.assigned[job_id] = cpus
+            return cpus
+
+    def release(self, job_id):
+        with self.lock:
+            cpus = self.assigned.pop(job_id, None)
+            if cpus is not None:
+                self.free = sorted(self.free + cpus)
@@ -0,0 +1,130 @@
+import heapq
+from time import time as _time
+
+
+class SubjobScheduler(object):
+    """
+    This class decides when subjobs get to start.
+
+    Up to max_running subjobs run at once.  The rest wait in a queue,
+    first in first out or last in first out, and start as slots free up.
+    With a ResourceTracker a subjob also waits until the CPU and memory
+    it asks for are free.  A subjob that has waited longer than
+    queue_timeout is started anyway so parents waiting on queued
+    children can't hold every slot forever.  Only one subjob gets
+    through that way per queue_timeout so the limit still holds
+    roughly, and it still has to fit in the free CPU and memory.
+    All calls are expected from the single _watch thread.
+    """
+
+    def __init__(self, max_running=20, max_queued=1000, queue_timeout=120,
+                 order='fifo', resources=None):
+        """
+        Inputs: running and queued limits, seconds before a queued subjob
+        is started over the limit (None to never do that), queue order
+        and an optional ResourceTracker
+        """
+        if order not in ['fifo', 'lifo']:
+            raise ValueError("Unknown subjob order {}".format(order))
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.order = order
+        self.resources = resources
+        self.queue = []
+        self.running = set()
+        self.seq = 0
+        self.last_escape = None
+        self.stats = {
+            'submitted': 0,
+            'started': 0,
+            'oversubscribed': 0,
+            'max_depth': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0
+        }
+
+    def add(self, job_id, data, now=None, hints=None):
+        """
+        Queue a subjob with optional cpus/memory hints.  Returns False if
+        the queue is full.
+        """
+        if len(self.queue) >= self.max_queued:
+            return False
+        if now is None:
+            now = _time()
+        self.seq += 1
+        prio = self.seq if self.order == 'fifo' else -self.seq
+        need = None
+        if self.resources is not None:
+            need = self.resources.request(hints)
+        heapq.heappush(self.queue, (prio, now, job_id, data, need))
+        self.stats['submitted'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'],
+                                      len(self.queue))
+        return True
+
+    def finished(self, job_id):
+        self.running.discard(job_id)
+        if self.resources is not None:
+            self.resources.release(job_id)
+
+    def _fits(self, need):
+        return self.resources is None or self.resources.fits(need)
+
+    def _expired(self, now):
+        if self.queue_timeout is None:
+            return False
+        if self.last_escape is not None and \
+                now - self.last_escape <= self.queue_timeout:
+            return False
+        # The oldest entry is the one that has waited longest
+        oldest = min(e[1] for e in self.queue)
+        return now - oldest > self.queue_timeout
+
+    def ready(self, now=None):
+        """
+        Return a list of (job_id, data, wait) to start now.
+        """
+        if now is None:
+            now = _time()
+        out = []
+        while len(self.queue) > 0:
+            if len(self.running) < self.max_running and \
+                    self._fits(self.queue[0][4]):
+                entry = heapq.heappop(self.queue)
+            elif self._expired(now):
+                entry = min(self.queue, key=lambda e: e[1])
+                # The timeout gets past the slot limit but not the node's
+                # CPU and memory
+                if not self._fits(entry[4]):
+                    break
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self.last_escape = now
+                self.stats['oversubscribed'] += 1
+            else:
+                break
+            (prio, queued, job_id, data, need) = entry
+            wait = now - queued
+            self.running.add(job_id)
+            if self.resources is not None:
+                self.resources.acquire(job_id, need)
+            self.stats['started'] += 1
+            self.stats['total_wait'] += wait
+            self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+            out.append((job_id, data, wait))
+        return out
+
+    def metrics(self):
+        """
+        Return queue depth and wait time numbers for this job.
+        """
+        m = dict(self.stats)
+        m['running'] = len(self.running)
+        m['depth'] = len(self.queue)
+        if m['started'] > 0:
+            m['avg_wait'] = m['total_wait'] / m['started']
+        else:
+            m['avg_wait'] = 0.0
+        return m
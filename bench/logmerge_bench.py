@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for merging docker stdout/stderr bursts.
+
+Compares the dict-and-sort interlacing DockerRunner used to do with
+LogMerger.  Reports lines/sec and peak traced memory per burst size.
+
+The "merge" rows interlace whole buffers at once, which is what
+_sort_lines_by_time does.  The "stream" rows feed the same output in
+docker sized frames the way _follow_logs does, through the old
+per-frame sort and through LogMerger.push.
+
+Usage: python bench/logmerge_bench.py [MB ...]
+"""
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from JobRunner.logmerge import LogMerger  # noqa: E402
+
+
+def old_sort_lines_by_time(sout, serr):
+    lines_by_time = dict()
+    for (buf, ierr) in [(sout, 0), (serr, 1)]:
+        if len(buf) > 0:
+            for line in buf.decode("utf-8").split('\n'):
+                if len(line) > 0:
+                    (ts, txt) = line.split(maxsplit=1)
+                    if ts not in lines_by_time:
+                        lines_by_time[ts] = []
+                    lines_by_time[ts].append({'line': txt, 'is_error': ierr})
+    nlines = []
+    for ts in sorted(lines_by_time.keys()):
+        nlines.extend(lines_by_time[ts])
+    return nlines
+
+
+def make_burst(mb):
+    """
+    Build stdout and stderr buffers totalling about mb megabytes with
+    interleaved, increasing timestamps.
+    """
+    sout = []
+    serr = []
+    size = 0
+    n = 0
+    text = 'progress: processed record {} of the input set'
+    while size < mb * 1024 * 1024:
+        # Roughly 50k lines per second, like a chatty container
+        ns = n * 20011
+        ts = '2019-07-08T23:{:02d}:{:02d}.{:09d}Z'.format(
+            21 + ns // (60 * 10**9), (ns // 10**9) % 60, ns % 10**9)
+        line = '{} {}\n'.format(ts, text.format(n)).encode('utf-8')
+        if n % 10 == 0:
+            serr.append(line)
+        else:
+            sout.append(line)
+        size += len(line)
+        n += 1
+    return b''.join(sout), b''.join(serr), n
+
+
+def old_follow(frames):
+    partial = [b'', b'']
+    nlines = []
+    for (is_error, data) in frames:
+        data = partial[is_error] + data
+        end = data.rfind(b'\n') + 1
+        partial[is_error] = data[end:]
+        if end == 0:
+            continue
+        if is_error:
+            nlines.extend(old_sort_lines_by_time(b'', data[:end]))
+        else:
+            nlines.extend(old_sort_lines_by_time(data[:end], b''))
+    nlines.extend(old_sort_lines_by_time(partial[0], partial[1]))
+    return nlines
+
+
+def new_follow(frames):
+    merger = LogMerger()
+    nlines = []
+    for (is_error, data) in frames:
+        nlines.extend(merger.push(is_error, data))
+    nlines.extend(merger.flush())
+    return nlines
+
+
+def make_frames(sout, serr, size=16384):
+    """
+    Cut both buffers into frames and alternate between the streams,
+    splitting lines across frames like docker does.
+    """
+    outs = [sout[i:i + size] for i in range(0, len(sout), size)]
+    errs = [serr[i:i + size] for i in range(0, len(serr), size)]
+    frames = []
+    for i in range(max(len(outs), len(errs))):
+        if i < len(outs):
+            frames.append((0, outs[i]))
+        if i < len(errs):
+            frames.append((1, errs[i]))
+    return frames
+
+
+def run(fn, sout, serr, nlines, repeat=3):
+    # Time without tracing since tracemalloc slows down allocations
+    best = None
+    for i in range(repeat):
+        start = perf_counter()
+        out = fn(sout, serr)
+        elapsed = perf_counter() - start
+        assert len(out) == nlines
+        out = None
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    out = fn(sout, serr)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return nlines / best, peak / (1024 * 1024)
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1, 4, 16]
+    fmt = '{:>4} MB {:>9} lines  {:<10} {:>12,.0f} lines/s {:>8.1f} MB peak'
+    for mb in sizes:
+        (sout, serr, n) = make_burst(mb)
+        frames = make_frames(sout, serr)
+        for (name, fn) in [
+                ('old merge', old_sort_lines_by_time),
+                ('merge', lambda o, e: LogMerger().merge(o, e)),
+                ('old stream', lambda o, e: old_follow(frames)),
+                ('stream', lambda o, e: new_follow(frames))]:
+            (rate, peak) = run(fn, sout, serr, n)
+            print(fmt.format(mb, n, name, rate, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Benchmark container monitoring with one thread per container against
+the shared ContainerMonitor loop.
+
+Each simulated container is a pipe that a producer thread writes log
+lines into.  The "threads" mode starts one reader thread per container
+the way DockerRunner and ShifterRunner used to.  The "monitor" mode
+watches every pipe from a single ContainerMonitor.  Each mode runs in
+its own process so CPU time and peak RSS can be read from getrusage.
+
+Usage: python bench/monitor_bench.py [containers] [seconds] [lines/sec]
+"""
+import os
+import sys
+import resource
+import subprocess
+from threading import Thread
+from time import sleep, perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from JobRunner.monitor import ContainerMonitor  # noqa: E402
+
+
+class Counter(object):
+    def __init__(self):
+        self.lines = 0
+
+    def log_lines(self, lines):
+        self.lines += len(lines)
+
+
+def producer(fds, seconds, rate):
+    line = b'2019-07-08T23:21:32.508696500Z progress: step done\n'
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        for fd in fds:
+            os.write(fd, line)
+        sleep(1.0 / rate)
+    for fd in fds:
+        os.close(fd)
+
+
+def reader_thread(fd, counter):
+    partial = b''
+    while True:
+        data = os.read(fd, 65536)
+        if len(data) == 0:
+            break
+        data = partial + data
+        end = data.rfind(b'\n') + 1
+        partial = data[end:]
+        counter.log_lines(data[:end].split(b'\n')[:-1])
+
+
+async def reader_coro(monitor, fd, counter):
+    loop = monitor.loop
+    done = loop.create_future()
+    state = {'partial': b''}
+
+    def _read():
+        data = os.read(fd, 65536)
+        if len(data) == 0:
+            loop.remove_reader(fd)
+            done.set_result(None)
+            return
+        data = state['partial'] + data
+        end = data.rfind(b'\n') + 1
+        state['partial'] = data[end:]
+        counter.log_lines(data[:end].split(b'\n')[:-1])
+
+    loop.add_reader(fd, _read)
+    await done
+
+
+def run_mode(mode, n, seconds, rate):
+    counter = Counter()
+    pipes = [os.pipe() for i in range(n)]
+    writers = [w for (r, w) in pipes]
+    readers = [r for (r, w) in pipes]
+    if mode == 'threads':
+        threads = [Thread(target=reader_thread, args=[r, counter])
+                   for r in readers]
+        for t in threads:
+            t.start()
+        waits = [t.join for t in threads]
+    else:
+        monitor = ContainerMonitor()
+        futures = [monitor.submit(reader_coro(monitor, r, counter))
+                   for r in readers]
+        waits = [f.result for f in futures]
+    producer(writers, seconds, rate)
+    for w in waits:
+        w()
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    print('{} {} {} {}'.format(ru.ru_utime + ru.ru_stime, ru.ru_maxrss,
+                               counter.lines, ru.ru_nvcsw + ru.ru_nivcsw))
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] in ['threads', 'monitor']:
+        run_mode(args[0], int(args[1]), float(args[2]), float(args[3]))
+        return
+    n = int(args[0]) if len(args) > 0 else 200
+    seconds = args[1] if len(args) > 1 else '5'
+    rate = args[2] if len(args) > 2 else '20'
+    print('{} containers, {}s, {} lines/s each'.format(n, seconds, rate))
+    for mode in ['threads', 'monitor']:
+        out = subprocess.check_output([sys.executable, __file__, mode,
+                                       str(n), seconds, rate])
+        (cpu, rss, lines, ctx) = out.decode('utf-8').split()
+        f = '{:<8} cpu {:>6.2f}s  max rss {:>7.1f} MB  ' + \
+            'context switches {:>8}  lines {}'
+        print(f.format(mode, float(cpu), int(rss) / 1024.0, ctx, lines))
+
+
+if __name__ == '__main__':
+    main()
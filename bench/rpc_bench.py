@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Benchmark JSON-RPC calls through BaseClient with a new connection per
+call against the pooled keep-alive session.
+
+A stand-in JSON-RPC server runs in this process on a local port and
+answers every call with an empty result, so the numbers are mostly
+connection setup and client overhead.  The "post" mode calls
+requests.post for every call the way BaseClient._call used to.  The
+"session" mode goes through BaseClient and its pooled session.  Each
+mode runs with the given number of threads, like concurrent log,
+cancel check and catalog calls from one job.
+
+Usage: python bench/rpc_bench.py [calls] [threads]
+"""
+import os
+import sys
+import json
+import requests
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from clients.baseclient import BaseClient  # noqa: E402
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body together like a real server would or
+    # delayed ACKs stall every kept-alive call
+    wbufsize = 65536
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        body = json.dumps({'version': '1.1', 'id': req['id'],
+                           'result': [{}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def post_call(url):
+    body = json.dumps({'method': 'NarrativeJobService.check_job_canceled',
+                       'params': [{'job_id': '1234'}], 'version': '1.1',
+                       'id': '1'})
+    ret = requests.post(url, data=body, headers={'AUTHORIZATION': 'bogus'},
+                        timeout=60)
+    return ret.json()['result']
+
+
+def run(mode, url, calls, threads):
+    client = BaseClient(url, token='bogus', timeout=60, pool_size=threads)
+
+    def _work(n):
+        for i in range(n):
+            if mode == 'post':
+                post_call(url)
+            else:
+                client.call_method('NarrativeJobService.check_job_canceled',
+                                   [{'job_id': '1234'}])
+
+    workers = [Thread(target=_work, args=[calls // threads])
+               for i in range(threads)]
+    start = perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = perf_counter() - start
+    total = (calls // threads) * threads
+    print('{:8s} {:6d} calls {:3d} threads {:8.3f}s {:10.1f} calls/sec'.format(
+        mode, total, threads, elapsed, total / elapsed))
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    server = Server(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    for n in sorted(set([1, threads])):
+        for mode in ['post', 'session']:
+            run(mode, url, calls, n)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
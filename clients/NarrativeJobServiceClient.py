@@ -23,7 +23,8 @@ class NarrativeJobService(object):
             self, url=None, timeout=30 * 60, user_id=None,
             password=None, token=None, ignore_authrc=False,
             trust_all_ssl_certificates=False,
-            auth_svc='https://ci.kbase.us/services/auth/api/legacy/KBase/Sessions/Login'):
+            auth_svc='https://ci.kbase.us/services/auth/api/legacy/KBase/Sessions/Login',
+            pool_size=10, keep_alive=True, connect_timeout=None):
         if url is None:
             raise ValueError('A url is required')
         self._service_ver = None
@@ -31,7 +32,8 @@ class NarrativeJobService(object):
             url, timeout=timeout, user_id=user_id, password=password,
             token=token, ignore_authrc=ignore_authrc,
             trust_all_ssl_certificates=trust_all_ssl_certificates,
-            auth_svc=auth_svc)
+            auth_svc=auth_svc, pool_size=pool_size,
+            keep_alive=keep_alive, connect_timeout=connect_timeout)
 
     def list_config(self, context=None):
         """
@@ -9,6 +9,7 @@ from __future__ import print_function
 
 import json as _json
 import requests as _requests
+from requests.adapters import HTTPAdapter as _HTTPAdapter
 import random as _random
 import os as _os
 import traceback as _traceback
@@ -120,6 +121,10 @@ class BaseClient(object):
     lookup_url - set to true when contacting KBase dynamic services.
     async_job_check_time_ms - the wait time between checking job state for
         asynchronous jobs run with the run_job method.
+    pool_size - the number of connections kept open to the service.
+    keep_alive - if False, close the connection after each call.
+    connect_timeout - fail if a connection can't be made in this many
+        seconds.  Defaults to timeout, which then only limits reads.
     '''
     def __init__(
             self, url=None, timeout=30 * 60, user_id=None,
@@ -129,7 +134,8 @@ class BaseClient(object):
             lookup_url=False,
             async_job_check_time_ms=100,
             async_job_check_time_scale_percent=150,
-            async_job_check_max_time_ms=300000):
+            async_job_check_max_time_ms=300000,
+            pool_size=10, keep_alive=True, connect_timeout=None):
         if url is None:
             raise ValueError('A url is required')
         scheme, _, _, _, _, _ = _urlparse(url)
@@ -163,6 +169,14 @@ class BaseClient(object):
                         authdata['user_id'], authdata['password'], auth_svc)
         if self.timeout < 1:
             raise ValueError('Timeout value must be at least 1 second')
+        self.connect_timeout = connect_timeout or self.timeout
+        # Reuse connections instead of a new TCP/TLS handshake per call
+        self._session = _requests.Session()
+        adapter = _HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if not keep_alive:
+            self._headers['Connection'] = 'close'
 
     def _call(self, url, method, params, context=None):
         arg_hash = {'method': method,
@@ -176,9 +190,9 @@ class BaseClient(object):
             arg_hash['context'] = context
 
         body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        ret = self._session.post(url, data=body, headers=self._headers,
+                                 timeout=(self.connect_timeout, self.timeout),
+                                 verify=not self.trust_all_ssl_certificates)
         ret.encoding = 'utf-8'
         if ret.status_code == 500:
             if ret.headers.get(_CT) == _AJ:
@@ -55,6 +55,93 @@ def main():
     if 'JR_MAX_TASKS' in os.environ:
         config['max_tasks'] = int(os.environ['JR_MAX_TASKS'])
 
+    if 'JR_LOG_BATCH_SIZE' in os.environ:
+        config['log_batch_size'] = int(os.environ['JR_LOG_BATCH_SIZE'])
+
+    if 'JR_LOG_FLUSH_INTERVAL' in os.environ:
+        interval = float(os.environ['JR_LOG_FLUSH_INTERVAL'])
+        config['log_flush_interval'] = interval
+
+    if 'JR_LOG_MAX_BYTES' in os.environ:
+        config['log_max_bytes'] = int(os.environ['JR_LOG_MAX_BYTES'])
+
+    if 'JR_LOG_CONTAINER_MAX_BYTES' in os.environ:
+        limit = int(os.environ['JR_LOG_CONTAINER_MAX_BYTES'])
+        config['log_container_max_bytes'] = limit
+
+    if 'JR_LOG_OVERFLOW_MAX_BYTES' in os.environ:
+        limit = int(os.environ['JR_LOG_OVERFLOW_MAX_BYTES'])
+        config['log_overflow_max_bytes'] = limit
+
+    if 'JR_LOG_RATE' in os.environ:
+        config['log_rate'] = float(os.environ['JR_LOG_RATE'])
+
+    if 'JR_MAX_QUEUED' in os.environ:
+        config['max_queued'] = int(os.environ['JR_MAX_QUEUED'])
+
+    if 'JR_SUBJOB_QUEUE_TIMEOUT' in os.environ:
+        timeout = float(os.environ['JR_SUBJOB_QUEUE_TIMEOUT'])
+        config['subjob_queue_timeout'] = timeout
+
+    if 'JR_SUBJOB_MEMORY' in os.environ:
+        config['subjob_memory'] = os.environ['JR_SUBJOB_MEMORY']
+
+    if 'JR_CALLBACK_INPROCESS' in os.environ:
+        config['callback_inprocess'] = True
+
+    if 'JR_OUTPUT_BUDGET' in os.environ:
+        config['output_budget'] = int(os.environ['JR_OUTPUT_BUDGET'])
+
+    if 'JR_CANCEL_CHECK_INTERVAL' in os.environ:
+        interval = float(os.environ['JR_CANCEL_CHECK_INTERVAL'])
+        config['cancel_check_interval'] = interval
+
+    if 'JR_CONTAINER_CPUS' in os.environ:
+        config['container_cpus'] = float(os.environ['JR_CONTAINER_CPUS'])
+
+    if 'JR_CONTAINER_MEMORY' in os.environ:
+        config['container_memory'] = os.environ['JR_CONTAINER_MEMORY']
+
+    if 'JR_CPUSET_PINNING' in os.environ:
+        config['cpuset_pinning'] = True
+
+    if 'JR_HINT_MEMORY_LIMIT' in os.environ:
+        config['hint_memory_limit'] = True
+
+    if 'JR_IMAGE_LOCK_DIR' in os.environ:
+        config['image_lock_dir'] = os.environ['JR_IMAGE_LOCK_DIR']
+
+    if 'JR_MAX_IMAGE_PULLS' in os.environ:
+        config['max_image_pulls'] = int(os.environ['JR_MAX_IMAGE_PULLS'])
+
+    if 'JR_MEMOIZE' in os.environ:
+        memoize = os.environ['JR_MEMOIZE'].split(',')
+        config['memoize'] = [m.strip() for m in memoize if m.strip()]
+
+    if 'JR_CATALOG_CACHE_DIR' in os.environ:
+        config['catalog_cache_dir'] = os.environ['JR_CATALOG_CACHE_DIR']
+
+    if 'JR_CATALOG_CACHE_TTL' in os.environ:
+        ttl = float(os.environ['JR_CATALOG_CACHE_TTL'])
+        config['catalog_cache_ttl'] = ttl
+
+    if 'JR_MODULE_MANIFEST' in os.environ:
+        config['module_manifest'] = os.environ['JR_MODULE_MANIFEST']
+
+    if 'JR_PREFETCH_MODULES' in os.environ:
+        modules = os.environ['JR_PREFETCH_MODULES'].split(',')
+        config['prefetch_modules'] = [m.strip() for m in modules]
+
+    if 'JR_RPC_POOL_SIZE' in os.environ:
+        config['rpc_pool_size'] = int(os.environ['JR_RPC_POOL_SIZE'])
+
+    if 'JR_RPC_CONNECT_TIMEOUT' in os.environ:
+        timeout = float(os.environ['JR_RPC_CONNECT_TIMEOUT'])
+        config['rpc_connect_timeout'] = timeout
+
+    if 'JR_CANCEL_TOKEN' in os.environ:
+        config['cancel_token'] = os.environ.pop('JR_CANCEL_TOKEN')
+
     token = _get_token()
     at = _get_admin_token()
     if not os.path.exists(config['workdir']):
@@ -3,6 +3,7 @@ from JobRunner.callback_server import app
 import json
 from queue import Queue
 from unittest.mock import patch
+from time import sleep
 _TOKEN = 'bogus'
 
 
@@ -77,3 +78,197 @@ def test_index_submit_sync(mock_uuid):
     response = _post(data)
     assert 'finished' in response.json
     assert 'foo' in response.json
+
+
+def test_cancel():
+    out_q = Queue()
+    conf = {
+            'token': _TOKEN,
+            'cancel_token': 'operator',
+            'out_q': out_q,
+            'in_q': Queue()
+        }
+    app.config.update(conf)
+    sa = {'access_log': False}
+    response = app.test_client.post('/cancel', server_kwargs=sa)[1]
+    assert response.status == 401
+    header = {"Authorization": 'wrong'}
+    response = app.test_client.post('/cancel', server_kwargs=sa,
+                                    headers=header)[1]
+    assert response.status == 401
+    assert out_q.empty()
+    header = {"Authorization": 'operator'}
+    response = app.test_client.post('/cancel', server_kwargs=sa,
+                                    headers=header)[1]
+    assert response.json['result'][0]['canceled'] is True
+    assert out_q.get() == ['cancel', None, None]
+
+
+def test_inprocess():
+    import socket
+    import requests
+    from threading import Thread
+    from JobRunner.callback_server import serve_inprocess
+    from JobRunner.monitor import ContainerMonitor
+    monitor = ContainerMonitor()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    out_q = Queue()
+    (server, in_q) = monitor.submit(serve_inprocess('127.0.0.1', port,
+                                                    out_q, _TOKEN)).result()
+    url = 'http://127.0.0.1:{}/'.format(port)
+    resp = []
+
+    def _call():
+        data = json.dumps({'method': 'bogus.run', 'params': []})
+        r = requests.post(url, data=data, headers={'Authorization': _TOKEN})
+        resp.append(r.json())
+
+    t = Thread(target=_call)
+    t.start()
+    (mtype, job_id, data) = out_q.get(timeout=5)
+    assert mtype == 'submit'
+    # Delivered straight to the waiting request
+    in_q.put(['output', job_id, {'result': [1]}])
+    t.join(timeout=5)
+    assert resp[0]['result'] == [1]
+    assert resp[0]['finished'] is True
+    monitor.loop.call_soon_threadsafe(server.close)
+    monitor.stop()
+
+
+def test_output_ref():
+    import hashlib
+    from tempfile import mkdtemp
+    from JobRunner.callback_server import _deliver
+    app.config.update({'token': _TOKEN, 'out_q': Queue(), 'in_q': Queue()})
+    d = mkdtemp()
+    for (job_id, body) in [('ref1', '{"result": [{"a": "}"}]}\n'),
+                           ('ref2', ' {  }\n')]:
+        path = '{}/{}.json'.format(d, job_id)
+        with open(path, 'w') as f:
+            f.write(body)
+        digest = hashlib.sha256(body.encode('utf-8')).hexdigest()
+        _deliver('output_ref', job_id, {'path': path, 'size': len(body),
+                                        'digest': digest})
+        data = json.dumps({'method': 'bogus._check_job',
+                           'params': [job_id]})
+        response = _post(data)
+        assert response.headers['X-Output-Digest'] == digest
+        assert response.json['result'][0]['finished'] is True
+        if job_id == 'ref1':
+            assert response.json['result'][0]['result'] == [{'a': '}'}]
+    assert response.json['result'] == [{'finished': True}]
+
+
+def test_check_job_wait():
+    import socket
+    import requests
+    from time import time
+    from multiprocessing import Process, Queue as MPQueue
+    from JobRunner.callback_server import start_callback_server
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    out_q = MPQueue()
+    in_q = MPQueue()
+    cbs = Process(target=start_callback_server,
+                  args=['127.0.0.1', port, out_q, in_q, _TOKEN])
+    cbs.start()
+    url = 'http://127.0.0.1:{}/'.format(port)
+    try:
+        for i in range(50):
+            try:
+                requests.get(url)
+                break
+            except requests.ConnectionError:
+                sleep(0.1)
+        data = json.dumps({'method': 'bogus._check_job',
+                           'params': ['job1', 0.2]})
+        start = time()
+        resp = requests.post(url, data=data).json()
+        assert resp['result'][0]['finished'] is False
+        assert time() - start >= 0.2
+        # The long-poll returns as soon as the output shows up
+        in_q_put = Process(target=_put_later,
+                           args=[in_q, ['output', 'job1', {'a': 1}]])
+        in_q_put.start()
+        data = json.dumps({'method': 'bogus._check_job',
+                           'params': ['job1', 30]})
+        start = time()
+        resp = requests.post(url, data=data).json()
+        assert resp['result'][0]['finished'] is True
+        assert time() - start < 0.9
+        in_q_put.join()
+    finally:
+        cbs.terminate()
+
+
+def _put_later(q, msg):
+    sleep(0.3)
+    q.put(msg)
+
+
+def test_stats():
+    response = app.test_client.get('/stats')[1]
+    assert 'entries' in response.json['outputs']
+
+
+def test_batch():
+    from tempfile import mkdtemp
+    from JobRunner.callback_server import _deliver
+    out_q = Queue()
+    in_q = Queue()
+    app.config.update({'token': _TOKEN, 'out_q': out_q, 'in_q': in_q})
+    calls = [{'method': 'bogus.run', 'params': [i]} for i in range(3)]
+    data = json.dumps({'method': 'bogus._submit_batch', 'params': [calls]})
+    job_ids = _post(data).json['result'][0]
+    assert len(job_ids) == 3
+    (mtype, _, batch) = out_q.get()
+    assert mtype == 'submit_batch'
+    assert [b[0] for b in batch] == job_ids
+    assert batch[2][1]['params'] == [2]
+    # Malformed batches are rejected instead of failing in the server
+    for bad in [[], {}, ['bogus.run'], [{'params': []}], [[{'method': 'x'}]],
+                [[{'method': 123.4}]]]:
+        data = json.dumps({'method': 'bogus._submit_batch', 'params': bad})
+        assert _post(data).status == 400
+    for bad in [[], [None], ['abc'], [[1, 2]], [job_ids, 'x']]:
+        data = json.dumps({'method': 'bogus._check_jobs', 'params': bad})
+        assert _post(data).status == 400
+    assert out_q.empty()
+    # Nothing done yet
+    data = json.dumps({'method': 'bogus._check_jobs', 'params': [job_ids]})
+    result = _post(data).json['result'][0]
+    assert [r['finished'] for r in result] == [False, False, False]
+    # as_completed only returns the finished ones
+    in_q.put(['output', job_ids[1], {'result': [1]}])
+    path = '{}/out.json'.format(mkdtemp())
+    with open(path, 'w') as f:
+        f.write('{"result": [2]}')
+    _deliver('output_ref', job_ids[2], {'path': path, 'size': 15,
+                                        'digest': 'x'})
+    opts = {'wait': 1, 'as_completed': True}
+    data = json.dumps({'method': 'bogus._check_jobs',
+                       'params': [job_ids, opts]})
+    result = _post(data).json['result'][0]
+    assert [r['job_id'] for r in result] == job_ids[1:]
+    assert [r['result'] for r in result] == [[1], [2]]
+    assert all(r['finished'] for r in result)
+
+
+def test_check_job_waiters():
+    from JobRunner.callback_server import waiters, waiting
+    app.config.update({'token': _TOKEN, 'out_q': Queue(), 'in_q': Queue()})
+    data = json.dumps({'method': 'bogus._check_job',
+                       'params': ['j1', 'soon']})
+    assert _post(data).status == 400
+    # A job that never finishes doesn't leave its waiter behind
+    data = json.dumps({'method': 'bogus._check_job',
+                       'params': ['ghost', 0.1]})
+    assert _post(data).json['result'][0]['finished'] is False
+    assert 'ghost' not in waiters
+    assert 'ghost' not in waiting
@@ -4,9 +4,10 @@ import unittest
 from unittest.mock import patch
 from mock import MagicMock
 
-from JobRunner.CatalogCache import CatalogCache
+from JobRunner.CatalogCache import CatalogCache, LookupCache
 from nose.plugins.attrib import attr
 from copy import deepcopy
+from tempfile import mkdtemp
 from .mock_data import CATALOG_GET_MODULE_VERSION, NJS_JOB_PARAMS,\
     CATALOG_LIST_VOLUME_MOUNTS, CATALOG_GET_SECURE_CONFIG_PARAMS
 
@@ -63,3 +64,80 @@ class CatalogCacheTest(unittest.TestCase):
         out = cc.get_volume_mounts('bogus', 'method', 'upload')
         self.assertTrue(len(out) > 0)
         self.assertIn('host_dir', out[0])
+
+    @patch('JobRunner.CatalogCache.Catalog', autospec=True)
+    def test_store(self, mock_cc):
+        cfg = deepcopy(self.cfg)
+        cfg['catalog_cache_dir'] = mkdtemp()
+        cc = CatalogCache(cfg)
+        cc.catalog.get_module_version.return_value = \
+            deepcopy(CATALOG_GET_MODULE_VERSION)
+        cc.catalog.get_secure_config_params.return_value = \
+            CATALOG_GET_SECURE_CONFIG_PARAMS
+        out = cc.get_module_info('bogus', None)
+        self.assertFalse(out['cached'])
+        # A second runner on the node doesn't need the catalog
+        cc2 = CatalogCache(cfg)
+        out2 = cc2.get_module_info('bogus', None)
+        self.assertFalse(out2['cached'])
+        self.assertEqual(out2['git_commit_hash'], out['git_commit_hash'])
+        self.assertEqual(out2['secure_config_params'],
+                         CATALOG_GET_SECURE_CONFIG_PARAMS)
+        self.assertEqual(cc2.catalog.get_module_version.call_count, 1)
+
+    @patch('JobRunner.CatalogCache.Catalog', autospec=True)
+    def test_versions(self, mock_cc):
+        cc = CatalogCache(self.cfg)
+        v1 = deepcopy(CATALOG_GET_MODULE_VERSION)
+        v2 = deepcopy(CATALOG_GET_MODULE_VERSION)
+        v2['git_commit_hash'] = 'other'
+        cc.catalog.get_module_version.side_effect = [v1, v2]
+        cc.catalog.get_secure_config_params.return_value = []
+        out = cc.get_module_info('bogus', 'release')
+        self.assertFalse(out['cached'])
+        out = cc.get_module_info('bogus', 'dev')
+        self.assertFalse(out['cached'])
+        self.assertEqual(out['git_commit_hash'], 'other')
+        out = cc.get_module_info('bogus', 'release')
+        self.assertTrue(out['cached'])
+        self.assertEqual(out['git_commit_hash'],
+                         CATALOG_GET_MODULE_VERSION['git_commit_hash'])
+        self.assertEqual(cc.catalog.get_module_version.call_count, 2)
+        self.assertEqual(cc.catalog.get_secure_config_params.call_count, 2)
+
+    @patch('JobRunner.CatalogCache.Catalog', autospec=True)
+    def test_volume_cache(self, mock_cc):
+        cc = CatalogCache(self.cfg)
+        vols = deepcopy(CATALOG_LIST_VOLUME_MOUNTS)
+        cc.catalog.list_volume_mounts = MagicMock(return_value=vols)
+        out = cc.get_volume_mounts('bogus', 'method', 'upload')
+        out[0]['host_dir'] = 'changed'
+        out = cc.get_volume_mounts('bogus', 'method', 'upload')
+        self.assertNotEqual(out[0]['host_dir'], 'changed')
+        cc.get_volume_mounts('bogus', 'method', 'njs')
+        self.assertEqual(cc.catalog.list_volume_mounts.call_count, 2)
+
+    def test_lookup_cache(self):
+        lc = LookupCache(size=2, ttl=10, neg_ttl=1)
+        fetch = MagicMock(return_value='a')
+        self.assertEqual(lc.get('k1', fetch, now=0), 'a')
+        self.assertEqual(lc.get('k1', fetch, now=5), 'a')
+        self.assertEqual(fetch.call_count, 1)
+        # Expired
+        lc.get('k1', fetch, now=11)
+        self.assertEqual(fetch.call_count, 2)
+        # Least recently used goes first
+        lc.get('k2', fetch, now=12)
+        lc.get('k1', fetch, now=12)
+        lc.get('k3', fetch, now=12)
+        self.assertEqual(list(lc.entries.keys()), ['k1', 'k3'])
+        # Failures are remembered for a short time
+        bad = MagicMock(side_effect=ValueError('missing'))
+        with self.assertRaises(ValueError):
+            lc.get('bad', bad, now=20)
+        with self.assertRaises(ValueError):
+            lc.get('bad', bad, now=20.5)
+        self.assertEqual(bad.call_count, 1)
+        with self.assertRaises(ValueError):
+            lc.get('bad', bad, now=22)
+        self.assertEqual(bad.call_count, 2)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import unittest
+from tempfile import mkdtemp
+from JobRunner.catalogstore import CatalogStore
+
+
+class CatalogStoreTest(unittest.TestCase):
+
+    def test_states(self):
+        path = os.path.join(mkdtemp(), 'node', 'catalog.db')
+        store = CatalogStore(path, ttl=10, stale=100)
+        self.assertEqual(store.get('mod:', now=0), (None, None))
+        store.put('mod:', {'a': 1}, now=0)
+        self.assertEqual(store.get('mod:', now=5), ({'a': 1}, 'fresh'))
+        self.assertEqual(store.get('mod:', now=50), ({'a': 1}, 'stale'))
+        self.assertEqual(store.get('mod:', now=200), (None, None))
+        # Another runner sees the same entries
+        other = CatalogStore(path, ttl=10, stale=100)
+        self.assertEqual(other.get('mod:', now=5), ({'a': 1}, 'fresh'))
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        self.assertEqual(mode, 0o600)
+
+    def test_claim_refresh(self):
+        path = os.path.join(mkdtemp(), 'catalog.db')
+        store = CatalogStore(path, ttl=10, stale=100)
+        store.put('mod:', {'a': 1}, now=0)
+        self.assertTrue(store.claim_refresh('mod:', now=50))
+        self.assertFalse(store.claim_refresh('mod:', now=51))
+        # Give up on a refresh that never finished
+        self.assertTrue(store.claim_refresh('mod:', now=70))
+        store.put('mod:', {'a': 2}, now=80)
+        self.assertEqual(store.get('mod:', now=81), ({'a': 2}, 'fresh'))
@@ -15,9 +15,12 @@ class MockLogger(object):
         self.errors = []
         self.all = []
 
-    def log_lines(self, lines):
+    def log_lines(self, lines, source=None):
         self.all.extend(lines)
 
+    def end_stream(self, source):
+        pass
+
     def log(self, line):
         self.lines.append(line)
         self.all.append([line, 0])
@@ -64,3 +67,107 @@ class DockerRunnerTest(unittest.TestCase):
         self.assertEquals(lines[2]['line'],'3')
         self.assertEquals(lines[3]['line'],'4')
         self.assertEquals(lines[1]['is_error'],1)
+
+    def test_follow_logs(self):
+        mlog = MockLogger()
+        dr = DockerRunner(logger=mlog)
+        frames = [
+            (0, b'2019-07-08T23:21:32.508696500Z 1\n2019-07-08T23:21:3'),
+            (1, b'2019-07-08T23:21:32.508797600Z 2\n'),
+            (0, b'2.508896500Z 3\n'),
+            (0, b'2019-07-08T23:21:32.508996500Z 4')
+        ]
+
+        async def _frames(c):
+            for f in frames:
+                yield f
+
+        dr._log_stream = _frames
+        dr.monitor.submit(dr._follow_logs(MagicMock(), '1234')).result()
+        self.assertEqual([l['line'] for l in mlog.all], ['1', '2', '3', '4'])
+        self.assertEqual(mlog.all[1]['is_error'], 1)
+
+    def test_events(self):
+        dr = DockerRunner()
+        # As if subscribed
+        dr._events = MagicMock()
+        c1 = MagicMock(id='c1')
+        c2 = MagicMock(id='c2')
+        for c in [c1, c2]:
+            dr.watchers[c.id] = {'done': False, 'waiter': None,
+                                 'exit_code': None, 'oom': False}
+        w1 = dr.watchers['c1']
+        w2 = dr.watchers['c2']
+        f1 = dr.monitor.submit(dr._wait_exit(c1, w1))
+        f2 = dr.monitor.submit(dr._wait_exit(c2, w2))
+        events = [
+            {'id': 'other', 'Action': 'die'},
+            {'id': 'c1', 'Action': 'oom'},
+            {'id': 'c1', 'Action': 'die',
+             'Actor': {'Attributes': {'exitCode': '137'}}},
+            {'id': 'c2', 'Action': 'destroy'}
+        ]
+        _sleep(0.1)
+        for ev in events:
+            dr.monitor.loop.call_soon_threadsafe(dr._handle_event, ev)
+        f1.result(timeout=5)
+        f2.result(timeout=5)
+        self.assertTrue(w1['oom'])
+        self.assertEqual(w1['exit_code'], 137)
+        self.assertTrue(w2['done'])
+        self.assertFalse(c1.reload.called)
+
+    def test_wait_exit_no_events(self):
+        from time import time
+        dr = DockerRunner()
+        c = MagicMock(id='c1', status='exited')
+        c.attrs = {'State': {'ExitCode': 3, 'OOMKilled': False}}
+        w = {'done': False, 'waiter': None, 'exit_code': None, 'oom': False}
+        start = time()
+        dr.monitor.submit(dr._wait_exit(c, w)).result(timeout=5)
+        # Checked right away instead of on the next poll
+        self.assertLess(time() - start, 1)
+        self.assertEqual(w['exit_code'], 3)
+        self.assertTrue(c.reload.called)
+
+    def test_get_image(self):
+        from docker.errors import ImageNotFound
+        from threading import Thread
+        mlog = MockLogger()
+        dr = DockerRunner(logger=mlog)
+        dr._events = MagicMock()
+        dr.docker = MagicMock()
+        found = MagicMock(id='sha256:1234')
+        dr.docker.images.get.side_effect = [ImageNotFound('missing'), found]
+
+        def _pull(repo, tag=None, stream=False, decode=False):
+            _sleep(0.2)
+            return [{'status': 'Pulling from mock_app', 'id': 'latest'},
+                    {'status': 'Pull complete', 'id': 'abc'},
+                    {'status': 'Digest: sha256:1234'}]
+
+        dr.docker.api.pull.side_effect = _pull
+        ids = []
+        threads = [Thread(target=lambda: ids.append(dr.get_image('mock_app')))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(ids, ['sha256:1234'] * 4)
+        self.assertEqual(dr.docker.api.pull.call_count, 1)
+        self.assertIn('abc: Pull complete', mlog.lines)
+        # Served from the index now
+        self.assertEqual(dr.get_image('mock_app:latest'), 'sha256:1234')
+        self.assertEqual(dr.docker.images.get.call_count, 2)
+        # An untag event drops it
+        dr._handle_image_event({'id': 'sha256:1234', 'Action': 'untag'})
+        self.assertEqual(dr.images, {})
+
+    def test_close(self):
+        dr = DockerRunner()
+        session = dr.monitor.submit(dr._get_session()).result()
+        dr.close()
+        self.assertTrue(session.closed)
+        self.assertIsNone(dr._session)
+        dr.monitor.stop()
@@ -7,6 +7,8 @@ from mock import MagicMock
 from JobRunner.JobRunner import JobRunner
 from nose.plugins.attrib import attr
 from copy import deepcopy
+from threading import Thread, current_thread
+from tempfile import mkdtemp
 from .mock_data import CATALOG_GET_MODULE_VERSION, NJS_JOB_PARAMS, \
         CATALOG_LIST_VOLUME_MOUNTS
 from requests import ConnectionError
@@ -18,9 +20,12 @@ class MockLogger(object):
         self.errors = []
         self.all = []
 
-    def log_lines(self, lines):
+    def log_lines(self, lines, source=None):
         self.all.extend(lines)
 
+    def end_stream(self, source):
+        pass
+
     def log(self, line):
         self.lines.append(line)
         self.all.append([line, 0])
@@ -178,6 +183,8 @@ class JobRunnerTest(unittest.TestCase):
         params[0]['params'] = [{'depth': 2, 'size': 1000, 'parallel': 5}]
         config = deepcopy(self.config)
         config['max_tasks'] = 2
+        # Extra subjobs queue now.  Only overflowing the queue cancels.
+        config['max_queued'] = 1
         jr = JobRunner(config, self.njs_url, self.jobid, self.token,
                        self.admin_token)
         rv = deepcopy(CATALOG_GET_MODULE_VERSION)
@@ -254,3 +261,244 @@ class JobRunnerTest(unittest.TestCase):
         with self.assertRaises(ConnectionError):
             jr.run()
         self.assertEquals(mlog.errors[0], 'Failed to get job parameters. Exiting.')
+
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    def test_submit_async(self, mock_njs, mock_auth):
+        from time import sleep, time
+        from threading import Thread
+        jr = JobRunner(self.config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.logger = MockLogger()
+        jr.prov = MagicMock()
+        jr.njs.check_job_canceled.return_value = {'finished': False}
+        rv = deepcopy(CATALOG_GET_MODULE_VERSION)
+        jr.cc.catalog.get_module_version = MagicMock(return_value=rv)
+        jr.cc.catalog.list_volume_mounts = MagicMock(return_value=[])
+        jr.cc.catalog.get_secure_config_params = MagicMock(return_value=None)
+        jr.cc.catalog.list_client_group_configs = MagicMock(return_value=[])
+
+        def _run(config, module_info, params, job_id, **kwargs):
+            if job_id == 'slow':
+                sleep(1)
+                return {}
+            raise OSError('pull failed')
+
+        jr.mr.run = MagicMock(side_effect=_run)
+        jr.mr.get_output = MagicMock(return_value={'result': 'ok'})
+        outputs = []
+
+        def _finish_main():
+            # The failed submit comes back as a finished subjob
+            outputs.append(jr.callback_queue.get(timeout=5))
+            jr.jr_queue.put(['finished', self.jobid, {}])
+
+        data = {'method': 'mock_app.bogus'}
+        start = time()
+        Thread(target=_finish_main).start()
+        jr.jr_queue.put(['submit', 'slow', data])
+        jr.jr_queue.put(['submit', 'bad', data])
+        out = jr._watch({'user': 'bogus'})
+        # The slow submit doesn't hold up the rest
+        self.assertLess(time() - start, 0.9)
+        self.assertEqual(out, {'result': 'ok'})
+        (_, job_id, output) = outputs[0]
+        self.assertEqual(job_id, 'bad')
+        self.assertIn('error', output)
+
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    def test_poll_cancel(self, mock_njs, mock_auth):
+        from threading import Thread
+        config = deepcopy(self.config)
+        config['cancel_check_interval'] = 0.01
+        config['cancel_check_max_interval'] = 0.04
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.logger = MockLogger()
+        jr.mr.cleanup_all = MagicMock()
+        nf = {'finished': False}
+        jr.njs.check_job_canceled.side_effect = [nf] * 5 + \
+            [{'finished': True}]
+        poller = Thread(target=jr._poll_cancel, daemon=True)
+        poller.start()
+        poller.join(timeout=5)
+        self.assertTrue(jr.canceled.is_set())
+        self.assertEqual(jr.njs.check_job_canceled.call_count, 6)
+        with patch('JobRunner.JobRunner._sleep'):
+            out = jr._watch({})
+        self.assertIn('error', out)
+        self.assertTrue(jr.mr.cleanup_all.called)
+
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    def test_submit_batch(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['resource_admission'] = False
+        config['max_tasks'] = 2
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.logger = MockLogger()
+        jr._submit_async = MagicMock()
+        data = {'method': 'mock_app.bogus'}
+        batch = [['sub{}'.format(i), data] for i in range(3)]
+        jr.jr_queue.put(['submit_batch', None, batch])
+        jr.jr_queue.put(['finished', self.jobid, {}])
+        jr.mr.get_output = MagicMock(return_value={})
+        jr._watch({})
+        # Two started and one still queued
+        self.assertEqual(jr.scheduler.metrics()['started'], 2)
+        self.assertEqual(jr.scheduler.metrics()['depth'], 1)
+
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    def test_memoize(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['resource_admission'] = False
+        config['callback_inprocess'] = True
+        config['memoize'] = ['mock_app']
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.logger = MockLogger()
+        jr._submit_async = MagicMock()
+        jr.cc.get_git_commit = MagicMock(return_value='abc')
+        ref = {'path': '/tmp/out.json', 'size': 2, 'digest': '1234',
+               'failed': False}
+        threads = []
+
+        def _ref(job_id):
+            threads.append(current_thread())
+            return ref
+
+        jr.mr.get_output_ref = MagicMock(side_effect=_ref)
+        jr.mr.get_output = MagicMock(return_value={})
+        watch = Thread(target=jr._watch, args=[{}])
+        watch.start()
+        data = {'method': 'mock_app.bogus', 'params': [{'a': 1}]}
+        jr._queue_subjob('sub1', data)
+        jr._queue_subjob('sub2', deepcopy(data))
+        jr.jr_queue.put(['finished', 'sub1', {}])
+        out = [jr.callback_queue.get(timeout=5) for i in range(2)]
+        self.assertEqual(out[0], ['output_ref', 'sub1', ref])
+        # Not hashed on the watch thread
+        self.assertNotIn(watch, threads)
+        self.assertEqual(out[1], ['output_ref', 'sub2', ref])
+        # Served from the cache now
+        jr._queue_subjob('sub3', deepcopy(data))
+        self.assertEqual(jr.callback_queue.get(timeout=5),
+                         ['output_ref', 'sub3', ref])
+        jr.jr_queue.put(['finished', self.jobid, {}])
+        watch.join()
+        self.assertEqual(jr._submit_async.call_count, 1)
+        self.assertEqual(jr.memo.stats,
+                         {'hits': 1, 'misses': 1, 'collapsed': 1})
+
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    def test_prefetch(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['resource_admission'] = False
+        config['prefetch_modules'] = ['mock_app.bogus:dev']
+        manifest = os.path.join(mkdtemp(), 'manifest')
+        with open(manifest, 'w') as f:
+            f.write('other\nbroken\n')
+        config['module_manifest'] = manifest
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.logger = MockLogger()
+
+        def _info(module, version):
+            if module == 'broken':
+                raise ValueError('no such module')
+            return {'docker_img_name': module + ':latest'}
+
+        jr.cc.prefetch_module = MagicMock(side_effect=_info)
+        jr.cc.get_volume_mounts = MagicMock(return_value=[])
+        jr.mr.runner.get_image = MagicMock(return_value='id')
+        jr._prefetch().shutdown(wait=True)
+        self.assertEqual(jr.cc.prefetch_module.call_count, 3)
+        jr.cc.prefetch_module.assert_any_call('mock_app', 'dev')
+        jr.cc.get_volume_mounts.assert_called_once_with(
+            'mock_app', 'bogus', jr.client_group)
+        images = sorted(c[0][0] for c in jr.mr.runner.get_image.call_args_list)
+        self.assertEqual(images, ['mock_app:latest', 'other:latest'])
+        self.assertIn('broken', jr.logger.errors[0])
+
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    def test_memoize_error(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['resource_admission'] = False
+        config['callback_inprocess'] = True
+        config['memoize'] = ['mock_app']
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.logger = MockLogger()
+        jr._submit_async = MagicMock()
+        jr.cc.get_git_commit = MagicMock(return_value='abc')
+        ref = {'path': '/tmp/out.json', 'size': 2, 'digest': '1234',
+               'failed': True}
+        jr.mr.get_output_ref = MagicMock(return_value=ref)
+        jr.mr.get_output = MagicMock(return_value={})
+        watch = Thread(target=jr._watch, args=[{}])
+        watch.start()
+        data = {'method': 'mock_app.bogus', 'params': [{'a': 1}]}
+        jr._queue_subjob('sub1', data)
+        jr._queue_subjob('sub2', deepcopy(data))
+        jr.jr_queue.put(['finished', 'sub1', {}])
+        out = [jr.callback_queue.get(timeout=5) for i in range(2)]
+        # The waiting duplicate still gets the failure
+        self.assertEqual(out[1], ['output_ref', 'sub2', ref])
+        # But it isn't cached so the next call runs again
+        jr._queue_subjob('sub3', deepcopy(data))
+        jr.jr_queue.put(['finished', 'sub3', {}])
+        self.assertEqual(jr.callback_queue.get(timeout=5),
+                         ['output_ref', 'sub3', ref])
+        jr.jr_queue.put(['finished', self.jobid, {}])
+        watch.join()
+        self.assertEqual(jr._submit_async.call_count, 2)
+        self.assertEqual(jr.memo.stats,
+                         {'hits': 0, 'misses': 2, 'collapsed': 1})
+
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    def test_submit_after_cancel(self, mock_njs, mock_auth):
+        jr = JobRunner(self.config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.logger = MockLogger()
+        info = deepcopy(CATALOG_GET_MODULE_VERSION)
+        info['cached'] = False
+        jr.cc.get_module_info = MagicMock(return_value=info)
+        jr.cc.get_volume_mounts = MagicMock(return_value=[])
+        jr._resource_hints = MagicMock(return_value=None)
+        jr.mr.run = MagicMock(return_value={})
+        jr.mr.cleanup_all = MagicMock()
+        # Still pulling when the cancel came in
+        jr._cancel()
+        with self.assertRaises(OSError):
+            jr._submit({}, 'sub1', {'method': 'mock_app.bogus'})
+        jr.mr.run.assert_not_called()
+
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    def test_queue_failed(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['callback_inprocess'] = True
+        config['memoize'] = ['mock_app']
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.logger = MockLogger()
+        jr._queue_subjob = MagicMock(side_effect=ValueError('broken'))
+        jr.mr.get_output = MagicMock(return_value={})
+        watch = Thread(target=jr._watch, args=[{}])
+        watch.start()
+        jr.jr_queue.put(['submit', 'sub1', {'method': 'mock_app.bogus'}])
+        (mtype, job_id, output) = jr.callback_queue.get(timeout=5)
+        self.assertEqual(job_id, 'sub1')
+        self.assertIn('broken', output['error']['message'])
+        # The main job still finishes normally
+        jr.jr_queue.put(['finished', self.jobid, {}])
+        watch.join(timeout=5)
+        self.assertFalse(watch.is_alive())
+        self.assertEqual(jr.logger.errors[0],
+                         'Failed to queue subjob sub1: broken')
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock
+from threading import Event, Thread
+from time import sleep
+
+from JobRunner.logger import Logger
+
+
+class LoggerTest(unittest.TestCase):
+
+    def test_batching(self):
+        njs = MagicMock()
+        logger = Logger('http://localhost', '1234', njs=njs,
+                        config={'log_flush_interval': 60})
+        for i in range(10):
+            logger.log('line %d' % (i))
+        logger.error('bad line')
+        logger.flush()
+        self.assertEqual(njs.add_job_logs.call_count, 1)
+        lines = njs.add_job_logs.call_args[0][1]
+        self.assertEqual(len(lines), 11)
+        self.assertEqual(lines[0]['line'], 'line 0')
+        self.assertEqual(lines[10]['is_error'], 1)
+        logger.close()
+
+    def test_batch_size(self):
+        njs = MagicMock()
+        conf = {'log_flush_interval': 60, 'log_batch_size': 5}
+        logger = Logger('http://localhost', '1234', njs=njs, config=conf)
+        for i in range(12):
+            logger.log_lines([{'line': str(i), 'is_error': 0}])
+        logger.close()
+        self.assertEqual(njs.add_job_logs.call_count, 3)
+        # Logging after close goes straight to NJS
+        logger.log('late')
+        self.assertEqual(njs.add_job_logs.call_count, 4)
+
+    def test_send_failure(self):
+        njs = MagicMock()
+        njs.add_job_logs.side_effect = OSError()
+        logger = Logger('http://localhost', '1234', njs=njs)
+        logger.log('line')
+        logger.close()
+        self.assertEqual(njs.add_job_logs.call_count, 1)
+
+    def test_journal_replay(self):
+        workdir = tempfile.mkdtemp()
+        njs = MagicMock()
+        njs.add_job_logs.side_effect = [OSError(), None]
+        conf = {'log_flush_interval': 60, 'workdir': workdir}
+        logger = Logger('http://localhost', '1234', njs=njs, config=conf)
+        logger.log('line 1')
+        logger.log('line 2')
+        logger.flush()
+        self.assertTrue(logger.replay)
+        logger.flush()
+        self.assertFalse(logger.replay)
+        self.assertEqual(njs.add_job_logs.call_count, 2)
+        lines = njs.add_job_logs.call_args[0][1]
+        self.assertEqual([l['line'] for l in lines], ['line 1', 'line 2'])
+        self.assertFalse(logger.journal.pending())
+        logger.close()
+        shutil.rmtree(workdir)
+
+    def test_journal_restart(self):
+        workdir = tempfile.mkdtemp()
+        njs = MagicMock()
+        njs.add_job_logs.side_effect = OSError()
+        conf = {'log_flush_interval': 60, 'workdir': workdir}
+        logger = Logger('http://localhost', '1234', njs=njs, config=conf)
+        logger.log('line 1')
+        logger.close()
+        # A new runner for the same job picks up the unsent lines
+        njs2 = MagicMock()
+        logger2 = Logger('http://localhost', '1234', njs=njs2, config=conf)
+        logger2.log('line 2')
+        logger2.close()
+        sent = []
+        for call in njs2.add_job_logs.call_args_list:
+            sent.extend([l['line'] for l in call[0][1]])
+        self.assertEqual(sent, ['line 1', 'line 2'])
+        shutil.rmtree(workdir)
+
+    def test_journal_cleanup(self):
+        workdir = tempfile.mkdtemp()
+        njs = MagicMock()
+        conf = {'log_flush_interval': 60, 'workdir': workdir}
+        logger = Logger('http://localhost', '1234', njs=njs, config=conf)
+        logger.log('line 1')
+        logger.close()
+        # Everything was sent so there is nothing to keep
+        self.assertEqual(os.listdir(workdir), [])
+        self.assertIsNone(logger.journal)
+        logger.log('late')
+        self.assertEqual(njs.add_job_logs.call_count, 2)
+        shutil.rmtree(workdir)
+
+    def test_late_lines_pending(self):
+        workdir = tempfile.mkdtemp()
+        njs = MagicMock()
+        njs.add_job_logs.side_effect = OSError()
+        conf = {'log_flush_interval': 60, 'workdir': workdir}
+        logger = Logger('http://localhost', '1234', njs=njs, config=conf)
+        logger.log('line 1')
+        logger.close()
+        self.assertIn('1234.logs', os.listdir(workdir))
+        # NJS is back so the late line goes out after the unsent one
+        njs.add_job_logs.side_effect = None
+        logger.retry_at = 0
+        logger.log('late')
+        lines = njs.add_job_logs.call_args[0][1]
+        self.assertEqual([l['line'] for l in lines], ['line 1', 'late'])
+        self.assertEqual(os.listdir(workdir), [])
+        shutil.rmtree(workdir)
+
+    def test_put_close_race(self):
+        njs = MagicMock()
+        logger = Logger('http://localhost', '1234', njs=njs,
+                        config={'log_flush_interval': 60})
+        # Close while a put is waiting on the lock
+        logger._put_lock.acquire()
+        t = Thread(target=logger.log, args=['racing'])
+        t.start()
+        sleep(0.1)
+        ev = Event()
+        logger.closed = True
+        logger.queue.put(('close', ev))
+        logger._put_lock.release()
+        ev.wait(5)
+        t.join(5)
+        lines = njs.add_job_logs.call_args[0][1]
+        self.assertEqual(lines[0]['line'], 'racing')
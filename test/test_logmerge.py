@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from JobRunner.logmerge import LogMerger, TimestampParser
+
+
+class LogMergeTest(unittest.TestCase):
+
+    def test_parse(self):
+        tp = TimestampParser()
+        t1 = tp.parse('2019-07-08T23:21:32.508696500Z')
+        self.assertEqual(t1, 1562628092508696500)
+        # Docker trims trailing zeros
+        self.assertEqual(tp.parse('2019-07-08T23:21:32.5086965Z'), t1)
+        self.assertEqual(tp.parse('2019-07-08T23:21:33Z'), 1562628093000000000)
+        with self.assertRaises(ValueError):
+            tp.parse('bogus')
+
+    def test_ties(self):
+        lm = LogMerger()
+        sout = b'2019-07-08T23:21:32.5Z a\n2019-07-08T23:21:32.5Z b\n'
+        serr = b'2019-07-08T23:21:32.5Z c\n2019-07-08T23:21:32.4Z d\n'
+        lines = lm.merge(sout, serr)
+        self.assertEqual([l['line'] for l in lines], ['d', 'a', 'b', 'c'])
+
+    def test_push(self):
+        lm = LogMerger()
+        self.assertEqual(lm.push(0, b'2019-07-08T23:21:32.5Z  indented'), [])
+        lines = lm.push(0, b' line\n2019-07-08T23:21:32.6Z ')
+        self.assertEqual(lines[0]['line'], ' indented line')
+        lines = lm.push(1, b'no timestamp\n')
+        self.assertEqual(lines[0]['line'], 'no timestamp')
+        self.assertEqual(lines[0]['is_error'], 1)
+        lines = lm.flush()
+        self.assertEqual(lines, [{'line': '', 'is_error': 0}])
+
+    def test_flush(self):
+        lm = LogMerger()
+        lm.push(1, b'2019-07-08T23:21:32.4Z err')
+        lm.push(0, b'2019-07-08T23:21:32.5Z out')
+        lines = lm.flush()
+        self.assertEqual(lines, [{'line': 'out', 'is_error': 0},
+                                 {'line': 'err', 'is_error': 1}])
+        self.assertEqual(lm.flush(), [])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from JobRunner.logpolicy import LogPolicy
+
+
+def _lines(texts, is_error=0):
+    return [{'line': t, 'is_error': is_error} for t in texts]
+
+
+class LogPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_collapse(self):
+        lp = LogPolicy({'workdir': self.workdir}, '1234')
+        out = lp.filter(_lines(['a', 'b', 'b', 'b', 'c']), 'job1')
+        self.assertEqual([l['line'] for l in out],
+                         ['a', 'b', 'Last line repeated 2 times', 'c'])
+        out = lp.filter(_lines(['c', 'c']), 'job1')
+        self.assertEqual(out, [])
+        out = lp.finish('job1')
+        self.assertEqual(out[0]['line'], 'Last line repeated 2 times')
+
+    def test_budget(self):
+        conf = {'workdir': self.workdir, 'log_container_max_lines': 3}
+        lp = LogPolicy(conf, '1234')
+        out = lp.filter(_lines([str(i) for i in range(10)]), 'job1')
+        self.assertEqual(len(out), 4)
+        self.assertIn('Log budget exceeded', out[3]['line'])
+        # Other containers have their own budget
+        out = lp.filter(_lines(['x']), 'job2')
+        self.assertEqual(len(out), 1)
+        of = os.path.join(self.workdir, '1234.overflow.log')
+        # Only what was held back is kept
+        with open(of) as f:
+            self.assertEqual(len(f.readlines()), 7)
+
+    def test_overflow(self):
+        of = os.path.join(self.workdir, '1234.overflow.log')
+        lp = LogPolicy({'workdir': self.workdir}, '1234')
+        lp.filter(_lines(['a', 'b']), 'job1')
+        self.assertFalse(os.path.exists(of))
+        conf = {'workdir': self.workdir, 'log_max_lines': 1,
+                'log_overflow_max_bytes': 20}
+        lp = LogPolicy(conf, '1234')
+        out = lp.filter(_lines(['a', 'b', 'c', 'd']), 'job1')
+        self.assertEqual(len(out), 3)
+        self.assertIn('truncated at 18 bytes', out[2]['line'])
+        with open(of) as f:
+            self.assertEqual(f.read(), 'job1 0 b\njob1 0 c\n')
+        out = lp.filter(_lines(['e']), 'job2')
+        self.assertIn('discarded', out[0]['line'])
+
+    def test_job_budget(self):
+        conf = {'log_max_bytes': 5}
+        lp = LogPolicy(conf, '1234')
+        out = lp.filter(_lines(['12345', '6']), 'job1')
+        self.assertEqual(len(out), 2)
+        self.assertIn('discarded', out[1]['line'])
+        out = lp.filter(_lines(['7']), 'job2')
+        self.assertIn('Log budget exceeded', out[0]['line'])
+
+    def test_rate_limit(self):
+        conf = {'workdir': self.workdir, 'log_rate': 0.001, 'log_burst': 2}
+        lp = LogPolicy(conf, '1234')
+        out = lp.filter(_lines(['a', 'b', 'c', 'd']), 'job1')
+        self.assertEqual(len(out), 3)
+        self.assertIn('Log rate limit reached', out[2]['line'])
+        out = lp.finish('job1')
+        self.assertIn('2 lines from job1 were rate limited', out[0]['line'])
+
+    def test_slow_rate(self):
+        conf = {'workdir': self.workdir, 'log_rate': 0.5}
+        lp = LogPolicy(conf, '1234')
+        self.assertEqual(lp.burst, 1)
+        out = lp.filter(_lines(['a', 'b']), 'job1')
+        self.assertEqual(out[0]['line'], 'a')
+        self.assertIn('Log rate limit reached', out[1]['line'])
+        # Refills to a whole token after two seconds
+        lp.streams['job1']['refill'] -= 2
+        out = lp.filter(_lines(['c']), 'job1')
+        self.assertEqual(out[-1]['line'], 'c')
+        with self.assertRaises(ValueError):
+            LogPolicy({'log_rate': 0}, '1234')
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from tempfile import mkdtemp
+from JobRunner.manifest import parse_entry, parse_entries, load_manifest
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test_parse_entry(self):
+        self.assertEqual(parse_entry('mod'), ('mod', None, None))
+        self.assertEqual(parse_entry('mod.meth'), ('mod', 'meth', None))
+        self.assertEqual(parse_entry(' mod:dev '), ('mod', None, 'dev'))
+        self.assertEqual(parse_entry('mod.meth:1.0.1'),
+                         ('mod', 'meth', '1.0.1'))
+
+    def test_load_manifest(self):
+        path = os.path.join(mkdtemp(), 'manifest')
+        with open(path, 'w') as f:
+            f.write('# Assembly pipeline\nmod1.run:release\n\n')
+            f.write('mod2, mod3  # trailing comment\n')
+        self.assertEqual(load_manifest(path),
+                         [('mod1', 'run', 'release'), ('mod2', None, None),
+                          ('mod3', None, None)])
+        self.assertEqual(parse_entries(''), [])
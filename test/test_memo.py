@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import unittest
+from JobRunner.memo import SubjobMemo
+
+
+class SubjobMemoTest(unittest.TestCase):
+
+    def test_allowed(self):
+        memo = SubjobMemo(['mod1', 'mod2.pure'])
+        self.assertTrue(memo.allowed('mod1.any'))
+        self.assertTrue(memo.allowed('mod2.pure'))
+        self.assertFalse(memo.allowed('mod2.other'))
+        self.assertFalse(SubjobMemo().allowed('mod1.any'))
+
+    def test_key(self):
+        memo = SubjobMemo()
+        k1 = memo.key('mod.meth', 'abc', [{'a': 1, 'b': 2}])
+        k2 = memo.key('mod.meth', 'abc', [{'b': 2, 'a': 1}])
+        self.assertEqual(k1, k2)
+        self.assertNotEqual(k1, memo.key('mod.meth', 'abd',
+                                         [{'a': 1, 'b': 2}]))
+        self.assertNotEqual(k1, memo.key('mod.meth', 'abc', [{'a': 1}]))
+
+    def test_claim(self):
+        memo = SubjobMemo(['mod'])
+        self.assertEqual(memo.claim('k', 'job1'), ('run', None))
+        self.assertEqual(memo.claim('k', 'job2'), ('wait', None))
+        self.assertEqual(memo.claim('k', 'job3'), ('wait', None))
+        self.assertEqual(memo.complete('job1', 'out'), ['job2', 'job3'])
+        self.assertEqual(memo.claim('k', 'job4'), ('hit', 'out'))
+        self.assertEqual(memo.complete('job4', 'out'), [])
+        self.assertEqual(memo.stats,
+                         {'hits': 1, 'misses': 1, 'collapsed': 2})
+
+    def test_no_cache(self):
+        memo = SubjobMemo(['mod'])
+        memo.claim('k', 'job1')
+        memo.claim('k', 'job2')
+        self.assertEqual(memo.complete('job1', 'err', cache=False),
+                         ['job2'])
+        self.assertEqual(memo.claim('k', 'job3'), ('run', None))
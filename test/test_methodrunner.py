@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from copy import deepcopy
 from queue import Queue
 
@@ -16,9 +16,12 @@ class MockLogger(object):
         self.lines = []
         self.errors = []
 
-    def log_lines(self, lines):
+    def log_lines(self, lines, source=None):
         self.lines.append(lines)
 
+    def end_stream(self, source):
+        pass
+
     def log(self, line):
         self.lines.append(line)
 
@@ -33,8 +36,9 @@ class MockRunner(object):
     def get_image(self, image):
         return '1234'
 
-    def run(self, job_id, image, env, vols, labels, qs):
+    def run(self, job_id, image, env, vols, labels, qs, limits=None):
         self.env = env
+        self.limits = limits
 
 
 class MethodRunnerTest(unittest.TestCase):
@@ -144,6 +148,90 @@ class MethodRunnerTest(unittest.TestCase):
         action = mr.run(self.conf, module_info, params, '1234', fin_q=q)
         self.assertIn('KBASE_SECURE_CONFIG_PARAM_param1', mockrunner.env)
 
+    def test_limits(self):
+        from JobRunner.resources import CpusetAllocator
+        cfg = deepcopy(self.cfg)
+        cfg['container_memory'] = '1G'
+        mr = MethodRunner(cfg, '1234', logger=MockLogger())
+        # Pinning is opt-in
+        self.assertIsNone(mr.cpusets)
+        mr.cpusets = CpusetAllocator([0, 1, 2, 3])
+        module_info = deepcopy(CATALOG_GET_MODULE_VERSION)
+        module_info['docker_img_name'] = 'mock_app:latest'
+        params = deepcopy(NJS_JOB_PARAMS[0])
+        params['method'] = 'echo_test.bogus'
+        mockrunner = MockRunner()
+        mr.runner = mockrunner
+        mr.run(self.conf, module_info, params, '1234', fin_q=Queue(),
+               resources={'cpus': 2})
+        self.assertEqual(mockrunner.limits['mem_limit'], 1024**3)
+        # The CPU hint is a request, not a cap
+        self.assertNotIn('nano_cpus', mockrunner.limits)
+        self.assertEqual(mockrunner.limits['cpuset_cpus'], '0,1')
+        # A concurrent job gets different cores
+        limits = mr._limits('sub1', {'cpus': 1.5})
+        self.assertEqual(limits['cpuset_cpus'], '2,3')
+        self.assertNotIn('cpuset_cpus', mr._limits('sub2', {'cpus': 1}))
+        mr.finished('1234')
+        self.assertEqual(mr._limits('sub3', {'cpus': 1})['cpuset_cpus'], '0')
+        # Memory hints are requests, not limits, unless asked for
+        limits = mr._limits('sub4', {'memory': 2 * 1024**3})
+        self.assertEqual(limits['mem_limit'], 1024**3)
+        mr.config['hint_memory_limit'] = True
+        limits = mr._limits('sub5', {'memory': 2 * 1024**3})
+        self.assertEqual(limits['mem_limit'], 2 * 1024**3)
+        mr.config['container_cpus'] = 0.5
+        limits = mr._limits('sub6', {'cpus': 4})
+        self.assertEqual(limits['nano_cpus'], 500000000)
+
+    def test_cleanup_all(self):
+        from time import sleep, time
+        mr = MethodRunner(self.cfg, '1234', logger=MockLogger())
+        mr.runner = MockRunner()
+        mr.runner.remove = lambda c: sleep(0.2)
+        mr.containers = {'sub{}'.format(i): 'c{}'.format(i)
+                         for i in range(5)}
+        # Finished containers are already gone
+        mr.finished('sub0')
+        start = time()
+        self.assertEqual(mr.cleanup_all(), 4)
+        self.assertLess(time() - start, 0.6)
+
+    def test_close(self):
+        mr = MethodRunner(self.cfg, '1234', logger=MockLogger())
+        mr.runner = MagicMock()
+        mr.close()
+        mr.runner.close.assert_called_once_with()
+        self.assertFalse(mr.monitor._thread.is_alive())
+        with self.assertRaises(RuntimeError):
+            mr.stages.submit(print)
+
+    def test_output_ref(self):
+        mr = MethodRunner(self.cfg, '1234', logger=MockLogger())
+        mr.subjobdir = '/tmp/mr/subjobs'
+        os.makedirs('/tmp/mr/subjobs/sub1', exist_ok=True)
+        with open('/tmp/mr/subjobs/sub1/output.json', 'w') as f:
+            f.write('{"result": [1]}')
+        ref = mr.get_output_ref('sub1')
+        self.assertEqual(ref['path'], '/tmp/mr/subjobs/sub1/output.json')
+        self.assertEqual(ref['size'], 15)
+        self.assertEqual(len(ref['digest']), 64)
+        self.assertFalse(ref['failed'])
+        ref = mr.get_output_ref('sub1', max_size=10)
+        self.assertIn('error', ref)
+        with open('/tmp/mr/subjobs/sub1/output.json', 'w') as f:
+            f.write('{"error": {"message": "bad"}}')
+        self.assertTrue(mr.get_output_ref('sub1')['failed'])
+        self.assertIn('Error in job', mr.logger.errors)
+        # Too big to load, only the start is checked
+        big = '"' + 'x' * 2 * 1024 * 1024 + '"'
+        with open('/tmp/mr/subjobs/sub1/output.json', 'w') as f:
+            f.write('{"result": [{"error": 1}, ' + big + ']}')
+        self.assertFalse(mr.get_output_ref('sub1')['failed'])
+        with open('/tmp/mr/subjobs/sub1/output.json', 'w') as f:
+            f.write('{"version": "1.1", "error": {"message": ' + big + '}}')
+        self.assertTrue(mr.get_output_ref('sub1')['failed'])
+
     def test_bad_method(self):
         mr = MethodRunner(self.cfg, '1234', logger=MockLogger())
         module_info = deepcopy(CATALOG_GET_MODULE_VERSION)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import unittest
+from tempfile import mkdtemp
+from JobRunner.outputstore import OutputStore, OutputRef
+
+
+class OutputStoreTest(unittest.TestCase):
+
+    def test_evict(self):
+        store = OutputStore(grace=10)
+        store.put('job1', {'result': [1]})
+        store.put('job2', {'result': [2]})
+        self.assertEqual(store.get('job1'), {'result': [1]})
+        store.evict(now=store.fetched['job1'] + 11)
+        # Fetched and past the grace period
+        self.assertIn('job1', store)
+        self.assertIn('error', store.get('job1'))
+        # Never fetched so still there
+        self.assertEqual(store.get('job2'), {'result': [2]})
+        s = store.stats()
+        self.assertEqual(s['entries'], 1)
+        self.assertEqual(s['evicted'], 1)
+        self.assertEqual(s['bytes'], len(json.dumps({'result': [2]})))
+
+    def test_spill(self):
+        d = mkdtemp()
+        store = OutputStore(budget=100, spill_dir=d, spill_size=50)
+        store.put('small', {'result': ['x']})
+        store.put('big', {'result': ['x' * 60]})
+        store.put('over', {'result': ['y' * 30]})
+        store.put('over2', {'result': ['z' * 30]})
+        self.assertIsInstance(store.get('small'), dict)
+        self.assertIsInstance(store.get('over'), dict)
+        ref = store.get('big')
+        self.assertIsInstance(ref, OutputRef)
+        with open(ref.path) as f:
+            self.assertEqual(json.load(f), {'result': ['x' * 60]})
+        # Past the budget
+        self.assertIsInstance(store.get('over2'), OutputRef)
+        self.assertLessEqual(store.bytes, 100)
+        self.assertEqual(store.stats()['spilled_entries'], 2)
+        store.evict(now=store.fetched['big'] + 1000)
+        self.assertFalse(os.path.exists(ref.path))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import unittest
+from multiprocessing import Process
+from threading import Thread, Lock
+from tempfile import mkdtemp
+from time import sleep
+from JobRunner.pullcoord import PullCoordinator
+
+
+def _pull_once(lock_dir, marker):
+    pc = PullCoordinator(lock_dir)
+
+    def _lookup():
+        if os.path.exists(marker):
+            return 'sha256:1234'
+        return None
+
+    def _pull():
+        with open(marker + '.pulls', 'a') as f:
+            f.write('pull\n')
+        sleep(0.3)
+        with open(marker, 'w') as f:
+            f.write('done')
+        return 'sha256:1234'
+
+    pc.pull('mock_app', _lookup, _pull)
+
+
+class PullCoordinatorTest(unittest.TestCase):
+
+    def test_single_pull(self):
+        lock_dir = mkdtemp()
+        marker = os.path.join(lock_dir, 'pulled')
+        procs = [Process(target=_pull_once, args=[lock_dir, marker])
+                 for i in range(4)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        with open(marker + '.pulls') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        pc = PullCoordinator(lock_dir)
+        self.assertEqual(pc.state()['mock_app']['id'], 'sha256:1234')
+        # Recorded and present so the image lock isn't needed
+        with pc._lock('image.{}'.format(
+                hashlib.sha1(b'mock_app').hexdigest())):
+            _pull_once(lock_dir, marker)
+
+    def test_shared_modes(self):
+        lock_dir = os.path.join(mkdtemp(), 'locks')
+        old = os.umask(0o022)
+        try:
+            pc = PullCoordinator(lock_dir)
+            pc.pull('mock_app', lambda: None, lambda: 'id')
+        finally:
+            os.umask(old)
+        self.assertEqual(os.stat(lock_dir).st_mode & 0o777, 0o777)
+        for name in os.listdir(lock_dir):
+            mode = os.stat(os.path.join(lock_dir, name)).st_mode
+            self.assertEqual(mode & 0o666, 0o666, name)
+
+    def test_max_pulls(self):
+        pc = PullCoordinator(mkdtemp(), max_pulls=2, poll=0.01)
+        lock = Lock()
+        state = {'running': 0, 'max': 0}
+
+        def _pull():
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            sleep(0.1)
+            with lock:
+                state['running'] -= 1
+            return 'id'
+
+        threads = [Thread(target=pc.pull,
+                          args=['image{}'.format(i), lambda: None, _pull])
+                   for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(state['max'], 2)
+        self.assertEqual(len(pc.state()), 6)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from tempfile import mkdtemp
+from JobRunner.resources import NodeResources, ResourceTracker, \
+    parse_hints, parse_memory
+from JobRunner.scheduler import SubjobScheduler
+
+_GB = 1024**3
+
+
+def _write(root, path, value):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(value + '\n')
+
+
+class MockNode(object):
+    def __init__(self, cpus, memory, free=None):
+        self.cpus = cpus
+        self.memory = memory
+        self.free = free
+
+    def free_memory(self):
+        return self.free
+
+
+class ResourcesTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_memory('2000M'), 2000 * 1024**2)
+        self.assertEqual(parse_memory('4G'), 4 * _GB)
+        self.assertEqual(parse_memory('500'), 500 * 1024**2)
+        hints = parse_hints(['njs,request_cpus=4,request_memory=2G'])
+        self.assertEqual(hints, {'cpus': 4.0, 'memory': 2 * _GB})
+        self.assertEqual(parse_hints(['njs']), {})
+
+    def test_cgroup_v2(self):
+        root = mkdtemp()
+        _write(root, 'htcondor/slot1/cpu.max', '200000 100000')
+        _write(root, 'htcondor/slot1/memory.max', str(_GB))
+        _write(root, 'htcondor/slot1/memory.current', str(_GB // 4))
+        node = NodeResources('/htcondor/slot1\n', root=root)
+        self.assertLessEqual(node.cpus, 2)
+        self.assertEqual(node.memory, _GB)
+        self.assertLessEqual(node.free_memory(), _GB - _GB // 4)
+
+    def test_cgroup_v1(self):
+        root = mkdtemp()
+        _write(root, 'cpu/htcondor/cpu.cfs_quota_us', '100000')
+        _write(root, 'cpu/htcondor/cpu.cfs_period_us', '100000')
+        _write(root, 'memory/htcondor/memory.limit_in_bytes', str(_GB))
+        node = NodeResources('/htcondor', root=root)
+        self.assertEqual(node.cpus, 1)
+        self.assertEqual(node.memory, _GB)
+
+    def test_no_cgroup(self):
+        node = NodeResources('Unknown', root=mkdtemp())
+        self.assertGreaterEqual(node.cpus, 1)
+        self.assertGreater(node.memory, 0)
+
+    def test_admission(self):
+        rt = ResourceTracker(MockNode(4, 6 * _GB, free=6 * _GB))
+        s = SubjobScheduler(max_running=10, resources=rt)
+        s.add('big1', {}, now=0, hints={'cpus': 2, 'memory': 4 * _GB})
+        s.add('big2', {}, now=0, hints={'cpus': 2, 'memory': 4 * _GB})
+        s.add('small', {}, now=0)
+        started = s.ready(now=0)
+        # Only one 4G job fits in 6G.  The rest wait their turn.
+        self.assertEqual([j for (j, d, w) in started], ['big1'])
+        s.finished('big1')
+        started = s.ready(now=1)
+        self.assertEqual([j for (j, d, w) in started], ['big2', 'small'])
+        # Memory that is actually in use counts too
+        rt.node.free = _GB
+        s.add('big3', {}, now=1, hints={'memory': 2 * _GB})
+        self.assertEqual(s.ready(now=2), [])
+
+    def test_admission_timeout(self):
+        rt = ResourceTracker(MockNode(8, 8 * _GB, free=8 * _GB))
+        s = SubjobScheduler(max_running=10, queue_timeout=120, resources=rt)
+        s.add('big1', {}, now=0, hints={'memory': 6 * _GB})
+        s.ready(now=0)
+        s.add('big2', {}, now=0, hints={'memory': 6 * _GB})
+        # Waiting on memory isn't cut short by the queue timeout
+        self.assertEqual(s.ready(now=200), [])
+        self.assertEqual(s.metrics()['oversubscribed'], 0)
+        s.finished('big1')
+        self.assertEqual(s.ready(now=201)[0][0], 'big2')
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import unittest
+from JobRunner.scheduler import SubjobScheduler
+
+
+class SubjobSchedulerTest(unittest.TestCase):
+
+    def test_fifo(self):
+        s = SubjobScheduler(max_running=2, queue_timeout=None)
+        for i in range(5):
+            self.assertTrue(s.add('job{}'.format(i), {}, now=0))
+        started = s.ready(now=1)
+        self.assertEqual([j for (j, d, w) in started], ['job0', 'job1'])
+        self.assertEqual(s.ready(now=2), [])
+        s.finished('job0')
+        started = s.ready(now=5)
+        self.assertEqual([(j, w) for (j, d, w) in started], [('job2', 5)])
+        m = s.metrics()
+        self.assertEqual(m['depth'], 2)
+        self.assertEqual(m['max_depth'], 5)
+        self.assertEqual(m['running'], 2)
+        self.assertEqual(m['max_wait'], 5)
+
+    def test_lifo(self):
+        s = SubjobScheduler(max_running=1, order='lifo')
+        for i in range(3):
+            s.add('job{}'.format(i), {}, now=0)
+        self.assertEqual(s.ready(now=0)[0][0], 'job2')
+
+    def test_max_queued(self):
+        s = SubjobScheduler(max_running=1, max_queued=2)
+        self.assertTrue(s.add('job0', {}))
+        self.assertTrue(s.add('job1', {}))
+        self.assertFalse(s.add('job2', {}))
+
+    def test_queue_timeout(self):
+        s = SubjobScheduler(max_running=1, queue_timeout=10)
+        s.add('parent', {}, now=0)
+        s.ready(now=0)
+        s.add('child', {}, now=1)
+        self.assertEqual(s.ready(now=5), [])
+        # The parent is waiting on the child so let it through
+        started = s.ready(now=12)
+        self.assertEqual(started[0][0], 'child')
+        self.assertEqual(s.metrics()['oversubscribed'], 1)
+
+    def test_queue_timeout_bounded(self):
+        s = SubjobScheduler(max_running=2, queue_timeout=120)
+        for i in range(10):
+            s.add('job{}'.format(i), {}, now=0)
+        self.assertEqual(len(s.ready(now=0)), 2)
+        # One at a time gets past the limit
+        self.assertEqual(len(s.ready(now=200)), 1)
+        self.assertEqual(s.metrics()['running'], 3)
+        self.assertEqual(s.ready(now=201), [])
+        self.assertEqual(s.ready(now=320), [])
+        self.assertEqual(len(s.ready(now=321)), 1)
+        self.assertEqual(s.metrics()['running'], 4)
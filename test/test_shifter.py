@@ -6,6 +6,7 @@ from JobRunner.ShifterRunner import ShifterRunner
 from nose.plugins.attrib import attr
 from queue import Queue
 from time import sleep
+from shutil import which
 
 
 class MockLogger(object):
@@ -14,9 +15,12 @@ class MockLogger(object):
         self.errors = []
         self.all = []
 
-    def log_lines(self, lines):
+    def log_lines(self, lines, source=None):
         self.all.extend(lines)
 
+    def end_stream(self, source):
+        pass
+
     def log(self, line):
         self.lines.append(line)
         self.all.append([line, 0])
@@ -33,6 +37,15 @@ class CatalogCacheTest(unittest.TestCase):
         cls.logger = MockLogger()
         cls.sr = ShifterRunner(logger=cls.logger)
 
+    def test_command(self):
+        cmd = self.sr._command('mock_app:latest', None)
+        self.assertEqual(cmd, ['shifter', '--image=mock_app:latest'])
+        limits = {'cpuset_cpus': '0,1', 'mem_limit': 1024**3}
+        cmd = self.sr._command('mock_app:latest', limits)
+        self.assertEqual(cmd[-2:], ['shifter', '--image=mock_app:latest'])
+        if which('taskset') is not None:
+            self.assertEqual(cmd[:3], ['taskset', '-c', '0,1'])
+
     def test_get_image(self):
         self.sr.get_image('mock_app:latest')
 